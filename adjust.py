@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+import sys
+import csv
+import datetime
+import traceback
+import logging
+import numpy as np
+import db
+import stock
+
+# Split and dividend adjusted prices. Ex-dates are kept in corporate_actions,
+# adjusted_price holds every trading day's cumulative factor with the OHLC
+# multiplied by it, so the first day stays as traded and a new action only
+# moves the rows from its ex-date on. adjust_state remembers the last day and
+# factor of each ticker; back adjusted series, the latest day as traded, are
+# the stored prices divided by that last factor.
+
+PRICE_FIELDS = ('open', 'high', 'low', 'close')
+ACTION_COLUMNS = ('stockno', 'date', 'cash', 'ratio')
+ADJUSTED_COLUMNS = ('stockno', 'date', 'factor', 'open', 'high', 'low', 'close')
+STATE_COLUMNS = ('stockno', 'date', 'factor', 'dirty')
+
+def parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Update the split and dividend adjusted prices')
+    parser.add_argument('dbname', type=str, help='DB name to operate')
+    parser.add_argument('-i', '--import', dest='actions', type=str, help='CSV of corporate actions to add first, columns stockno,date,cash,ratio (ex. 2330,20170619,7,1)')
+    parser.add_argument('-d', '--date', type=str, help='Last date to adjust, format YYYYMMDD (default today)')
+    parser.add_argument('--rebuild', action='store_true', help='Drop the adjusted prices and recompute every ticker from its first day')
+    parser.add_argument('-b', '--batch', type=int, default=200, help='Tables read per query')
+
+    return parser
+
+def create_tables(cursor):
+    # ratio is shares held after the action per share before, ex. 2 for a
+    # 2-for-1 split or 1.1 for a 10% stock dividend; cash is paid per share
+    cmd = 'create table if not exists corporate_actions ( stockno text not null, date date not null, cash float8 not null default 0, ratio float8 not null default 1, primary key ( stockno, date ) )'
+    cursor.execute(cmd)
+    cmd = 'create table if not exists adjusted_price ( stockno text not null, date date not null, factor float8 not null, open real, high real, low real, close real, primary key ( stockno, date ) )'
+    cursor.execute(cmd)
+    cmd = 'create table if not exists adjust_state ( stockno text primary key, date date not null, factor float8 not null, dirty date )'
+    cursor.execute(cmd)
+
+def read_actions_csv(path):
+    rows = []
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            rows.append((row['stockno'].strip(), stock.to_date(row['date'].strip()),
+                         float(row.get('cash') or 0), float(row.get('ratio') or 1)))
+
+    return rows
+
+def add_actions(cursor, rows):
+    # a later record of the same ex-date replaces the earlier one, tickers
+    # already adjusted past it get recomputed from there on the next update
+    if not rows:
+        return
+
+    cmd = 'insert into corporate_actions values %s on conflict ( stockno, date ) do update set cash = excluded.cash, ratio = excluded.ratio'
+    db.execute_values(cursor, cmd, rows)
+    cmd = 'update adjust_state s set dirty = least(s.dirty, a.date) from ( values %s ) a ( stockno, date ) where s.stockno = a.stockno and a.date <= s.date'
+    db.execute_values(cursor, cmd, [(r[0], r[1]) for r in rows], template='( %s, %s::date )')
+
+def read_actions(cursor):
+    # stockno -> [ ( date, cash, ratio ) ]
+    actions = {}
+    cursor.execute('select %s from corporate_actions order by stockno, date' % ', '.join(ACTION_COLUMNS))
+    for row in cursor.fetchall():
+        actions.setdefault(row[0], []).append(row[1:])
+
+    return actions
+
+def read_anchors(cursor):
+    # stockno -> ( date, factor ) of the last adjusted day that stays as it is;
+    # a dirty ticker goes back to the day before its earliest new action
+    cursor.execute('select stockno, date, factor from adjust_state where dirty is null')
+    anchors = dict((row[0], row[1:]) for row in cursor.fetchall())
+
+    cmd = 'select s.stockno, a.date, a.factor from adjust_state s cross join lateral ( select date, factor from adjusted_price p where p.stockno = s.stockno and p.date < s.dirty order by date desc limit 1 ) a where s.dirty is not null'
+    cursor.execute(cmd)
+    anchors.update((row[0], row[1:]) for row in cursor.fetchall())
+
+    return anchors
+
+def factors(frame, base, actions):
+    # cumulative factor of every ticker x date, actions are ( row, date, cash, ratio )
+    close = frame['close']
+    n, t = close.shape
+    step = np.ones((n, t))
+    if not actions or not t:
+        return base[:, None] * step
+
+    rows, dates, cash, ratio = [np.array(c) for c in zip(*actions)]
+    pos = np.searchsorted(frame.dates, dates.astype('datetime64[D]'))
+    # an ex-date past the last day is applied once that day is stored
+    keep = pos < t
+    rows, dates, pos, cash, ratio = rows[keep], dates[keep], pos[keep], cash[keep], ratio[keep]
+
+    # last close before the ex-date, carried over days a ticker didn't trade
+    seen = np.maximum.accumulate(np.where(np.isnan(close), -1, np.arange(t)), axis=1)
+    prev = np.where(pos > 0, seen[rows, np.maximum(pos - 1, 0)], -1)
+    prev_close = np.where(prev >= 0, close[rows, np.maximum(prev, 0)], np.nan)
+
+    priced = prev_close > cash
+    for i in np.flatnonzero(~priced & (cash > 0)):
+        logging.error('%s: %s: no close above the cash dividend before the ex-date, dividend ignored' % (frame.stocknos[rows[i]], dates[i]))
+    with np.errstate(invalid='ignore'):
+        kept = np.where(priced, (prev_close - cash) / prev_close, 1.0)
+
+    np.multiply.at(step, (rows, pos), ratio / kept)
+
+    return base[:, None] * np.cumprod(step, axis=1)
+
+def adjust(frame, base, actions):
+    # adjusted rows and the new state of every ticker that has a day in frame
+    factor = factors(frame, base, actions)
+    adjusted = [frame[f] * factor for f in PRICE_FIELDS]
+    traded = ~np.isnan(frame['close'])
+
+    rows = []
+    days = frame.dates.astype(datetime.date)
+    for i, j in zip(*np.nonzero(traded)):
+        values = [None if np.isnan(a[i, j]) else round(float(a[i, j]), 4) for a in adjusted]
+        rows.append([frame.stocknos[i], days[j], repr(float(factor[i, j]))] + values)
+
+    state = []
+    last = np.where(traded.any(axis=1), traded.shape[1] - 1 - np.argmax(traded[:, ::-1], axis=1), -1)
+    for i in np.flatnonzero(last >= 0):
+        state.append((frame.stocknos[i], days[last[i]], repr(float(factor[i, last[i]])), None))
+
+    return rows, state
+
+def write(cursor, rows, state):
+    cursor.execute('create temp table if not exists adjusted_stage ( like adjusted_price ) on commit drop')
+    db.copy_rows(cursor, 'adjusted_stage', ADJUSTED_COLUMNS, rows)
+    updates = ', '.join('%s = excluded.%s' % (c, c) for c in ADJUSTED_COLUMNS[2:])
+    cmd = 'insert into adjusted_price select * from adjusted_stage on conflict ( stockno, date ) do update set %s' % updates
+    cursor.execute(cmd)
+
+    cursor.execute('create temp table if not exists adjust_state_stage ( like adjust_state ) on commit drop')
+    db.copy_rows(cursor, 'adjust_state_stage', STATE_COLUMNS, state)
+    updates = ', '.join('%s = excluded.%s' % (c, c) for c in STATE_COLUMNS[1:])
+    cmd = 'insert into adjust_state select * from adjust_state_stage on conflict ( stockno ) do update set %s' % updates
+    cursor.execute(cmd)
+
+def update(dbname, end=None, rebuild=False, batch=200):
+    # returns the number of adjusted rows written
+    end = stock.to_date(end) if end else datetime.date.today()
+    store = stock.Store(dbname)
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        create_tables(cursor)
+        if rebuild:
+            cursor.execute('truncate adjusted_price, adjust_state')
+        tables = store.tables(cursor)
+        stocknos = [s for s in store.tickers(cursor) if 'close' in tables.get(s, tables.get('daily_price', ()))]
+        anchors = read_anchors(cursor)
+        actions = read_actions(cursor)
+        conn.commit()
+
+    # tickers resuming from the same day are read together, on a daily run
+    # that is all of them but the few with a new action
+    groups = {}
+    for stockno in stocknos:
+        anchor = anchors.get(stockno)
+        groups.setdefault(anchor[0] if anchor else None, []).append(stockno)
+
+    rows = []
+    state = []
+    for since, names in sorted(groups.items(), key=lambda g: g[0] or datetime.date.min):
+        # the anchor day is read again, its close prices the first ex-date after it
+        start = since or datetime.date(1900, 1, 1)
+        frame = store.load(names, start, end, PRICE_FIELDS, batch, cache=False)
+        base = np.array([anchors[s][1] if s in anchors else 1.0 for s in names])
+        pending = [(i, date, cash, ratio) for i, s in enumerate(names) for date, cash, ratio in actions.get(s, ())
+                   if since is None or date > since]
+        more_rows, more_state = adjust(frame, base, pending)
+        rows.extend(r for r in more_rows if since is None or r[1] > since)
+        state.extend(more_state)
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        write(cursor, rows, state)
+        conn.commit()
+
+    return len(rows)
+
+def load(stocknos, start, end, fields=PRICE_FIELDS, dbname='stock', back=True):
+    # adjusted prices as a stock.Frame, back adjusted unless back is False
+    if isinstance(stocknos, str):
+        stocknos = [stocknos]
+    stocknos = list(stocknos)
+    fields = tuple(fields)
+
+    scale = ' / s.factor' if back else ''
+    select = ', '.join('p.%s%s' % (f, scale) for f in fields)
+    cmd = 'select p.stockno, p.date, %s from adjusted_price p join adjust_state s on s.stockno = p.stockno where p.stockno = any(%%s) and p.date between %%s and %%s order by 1, 2' % select
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        cursor.execute(cmd, (stocknos, stock.to_date(start), stock.to_date(end)))
+        data = {}
+        for row in cursor.fetchall():
+            data.setdefault(row[0], []).append(row[1:])
+        conn.commit()
+
+    per_stock = []
+    for stockno in stocknos:
+        rows = data.get(stockno, [])
+        dates = np.array([r[0] for r in rows], dtype='datetime64[D]')
+        values = [np.array([np.nan if r[i + 1] is None else r[i + 1] for r in rows], dtype=np.float64) for i in range(len(fields))]
+        per_stock.append((dates, values))
+
+    return stock.align(stocknos, fields, per_stock)
+
+def main(argv):
+    args = parser().parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s\t%(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    if args.date:
+        try:
+            datetime.datetime.strptime(args.date, '%Y%m%d')
+        except ValueError as e:
+            logging.error('Invalid Date: %s' % args.date)
+            sys.exit(1)
+
+    if args.actions:
+        rows = read_actions_csv(args.actions)
+        with db.connection(args.dbname) as conn:
+            cursor = conn.cursor()
+            create_tables(cursor)
+            add_actions(cursor, rows)
+            conn.commit()
+        logging.info('%d corporate actions added' % len(rows))
+
+    rows = update(args.dbname, args.date, args.rebuild, args.batch)
+    logging.info('%d adjusted rows written' % rows)
+    db.close_all()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit(1)
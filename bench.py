@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import sys
+import traceback
+import time
+import logging
+import datetime
+import getpass
+import psycopg2
+import fixtureserver
+import updatedb
+import sources
+import db
+
+def parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark updatedb ingestion against the fixture server')
+    parser.add_argument('dbname', type=str, help='Throwaway DB to create, it is dropped afterwards')
+    parser.add_argument('-n', '--days', type=int, default=20, help='Number of synthetic trading days')
+    parser.add_argument('--stocks', type=int, default=1000, help='Number of stocks per day')
+    parser.add_argument('-d', '--date', type=str, default='20170621', help='Newest date, format YYYYMMDD')
+    parser.add_argument('-s', '--storage', choices=['table', 'long'], default='table', help='Storage mode to benchmark')
+    parser.add_argument('-m', '--market', choices=list(sources.registry), default='twse', help='Market whose reports are ingested')
+    parser.add_argument('--keep', action='store_true', help='Keep the DB after the run')
+
+    return parser
+
+class Stages(object):
+    def __init__(self):
+        self.times = {}
+
+    def add(self, name, secs):
+        self.times[name] = self.times.get(name, 0) + secs
+
+    def timed(self, name, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.add(name, time.time() - start)
+        return result
+
+def admin_execute(cmd):
+    conn = psycopg2.connect(database='postgres', user=getpass.getuser())
+    conn.autocommit = True
+    conn.cursor().execute(cmd)
+    conn.close()
+
+def run(dbname, source, days, date, storage):
+    stages = Stages()
+    rows = 0
+    got = 0
+    dt = datetime.datetime.strptime(date, '%Y%m%d')
+
+    while got < days:
+        date = dt.strftime('%Y%m%d')
+        dt -= datetime.timedelta(1)
+
+        data = stages.timed('fetch', updatedb.get_price_info, source, date)
+        if not data:
+            continue
+        cols = stages.timed('parse', updatedb.parse_price_info, source, date, data, storage)
+        stages.timed('write', updatedb.write_price_info, dbname, cols, storage, source.dataset('price'))
+        rows += len(cols['stockno'])
+
+        info = stages.timed('fetch', updatedb.get_trade_info, source, date)
+        if info:
+            cols = stages.timed('parse', updatedb.parse_trade_info, source, date, info)
+            stages.timed('write', updatedb.write_trade_info, dbname, date, cols, storage, source.dataset('trade'))
+        got += 1
+
+    return rows, stages
+
+def main(argv):
+    args = parser().parse_args(argv[1:])
+
+    # weekends in the synthetic range would log missing data5 otherwise
+    logging.basicConfig(level=logging.CRITICAL)
+
+    srv, url = fixtureserver.start_server(stocks=args.stocks)
+    source = sources.select([args.market], url)[0]
+    updatedb.response_cache = None
+
+    admin_execute('create database "%s"' % args.dbname)
+    try:
+        start = time.time()
+        rows, stages = run(args.dbname, source, args.days, args.date, args.storage)
+        elapsed = time.time() - start
+    finally:
+        db.close_all()
+        if not args.keep:
+            admin_execute('drop database "%s"' % args.dbname)
+        srv.shutdown()
+
+    print('Market: %s, days: %d, stocks: %d, storage: %s' % (args.market, args.days, args.stocks, args.storage))
+    print('Price rows: %d in %.3fs, %.1f rows/sec' % (rows, elapsed, rows / elapsed))
+    for name in ['fetch', 'parse', 'write']:
+        secs = stages.times.get(name, 0)
+        print('%-6s %8.3fs %5.1f%%' % (name, secs, secs / elapsed * 100))
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit(1)
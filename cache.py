@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+import threading
+
+class ResponseCache(object):
+    def __init__(self, path, max_bytes=1 << 30, refresh=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.size = sum(size for fname, size, mtime in self.entries())
+
+    def key(self, endpoint, params):
+        # the '_' cache buster changes on every call, keep it out of the key
+        items = sorted((k, str(v)) for k, v in params.items() if k != '_')
+        raw = json.dumps([endpoint, items])
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], '%s.json.gz' % key)
+
+    def entries(self):
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith('.json.gz'):
+                    continue
+                fname = os.path.join(root, name)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                yield fname, st.st_size, st.st_mtime
+
+    def get(self, endpoint, params):
+        if self.refresh:
+            return None
+
+        fname = self.filename(self.key(endpoint, params))
+        try:
+            with gzip.open(fname, 'rt', encoding='utf-8') as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # mark as recently used for eviction
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+
+        return content
+
+    def put(self, endpoint, params, content):
+        fname = self.filename(self.key(endpoint, params))
+        dirname = os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        tmp = '%s.%d.tmp' % (fname, threading.get_ident())
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            json.dump(content, f)
+        size = os.path.getsize(tmp)
+
+        with self.lock:
+            if os.path.exists(fname):
+                self.size -= os.path.getsize(fname)
+            os.replace(tmp, fname)
+            self.size += size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # drop least recently used entries until back under 90% of the limit
+        target = self.max_bytes * 0.9
+        for fname, size, mtime in sorted(self.entries(), key=lambda e: e[2]):
+            if self.size <= target:
+                break
+            try:
+                os.remove(fname)
+            except OSError as e:
+                logging.error('Can\'t evict %s: %s' % (fname, e))
+                continue
+            self.size -= size
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import getpass
+import threading
+import contextlib
+import io
+import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.extras
+from psycopg2 import sql
+from psycopg2.extensions import quote_ident
+import metrics
+
+_pools = {}
+_lock = threading.Lock()
+
+class MeteredCursor(psycopg2.extensions.cursor):
+    # every statement and COPY is counted and timed
+    def execute(self, query, vars=None):
+        metrics.inc('db_statements', kind='execute')
+        with metrics.timer('db_execute'):
+            return super(MeteredCursor, self).execute(query, vars)
+
+    def copy_from(self, *args, **kwargs):
+        metrics.inc('db_statements', kind='copy')
+        with metrics.timer('db_copy'):
+            return super(MeteredCursor, self).copy_from(*args, **kwargs)
+
+class MeteredConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault('cursor_factory', MeteredCursor)
+        return super(MeteredConnection, self).cursor(*args, **kwargs)
+
+    def commit(self):
+        with metrics.timer('db_commit'):
+            super(MeteredConnection, self).commit()
+
+def get_pool(dbname, maxconn=4):
+    with _lock:
+        pool = _pools.get(dbname)
+        if pool is None:
+            pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, database=dbname,
+                                                        user=getpass.getuser(),
+                                                        connection_factory=MeteredConnection)
+            _pools[dbname] = pool
+
+    return pool
+
+def get_conn(dbname):
+    return get_pool(dbname).getconn()
+
+def put_conn(dbname, conn):
+    # roll back anything left open so the next user starts clean
+    if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+        conn.rollback()
+    get_pool(dbname).putconn(conn)
+
+@contextlib.contextmanager
+def connection(dbname):
+    conn = get_conn(dbname)
+    try:
+        yield conn
+    finally:
+        put_conn(dbname, conn)
+
+def close_all():
+    with _lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+def ident(name):
+    # quoted table or column name for sql.SQL(...).format()
+    return sql.Identifier(name)
+
+def execute_values(cursor, query, rows, template=None, page_size=1000):
+    # one multi-row statement per page instead of a statement per row
+    metrics.inc('db_rows_batched', len(rows))
+    return psycopg2.extras.execute_values(cursor, query, rows, template, page_size)
+
+def execute_tables(cursor, template, rows):
+    # rows are ( table, params ), template has {t} for the quoted table name and
+    # %s placeholders; everything is bound client side and sent in one round trip.
+    # Each table gets one row per call, so a server-side PREPARE per table would
+    # only add an EXECUTE's overhead without ever reusing a plan
+    if not rows:
+        return
+
+    cmds = []
+    params = []
+    for table, values in rows:
+        cmds.append(template.replace('{t}', quote_ident(table, cursor).replace('%', '%%')))
+        params.extend(values)
+    cursor.execute(cursor.mogrify(';\n'.join(cmds), params))
+
+def copy_rows(cursor, table, columns, rows):
+    # bulk load through COPY, None goes in as NULL
+    buf = io.StringIO()
+    for r in rows:
+        buf.write('\t'.join('\\N' if v is None else str(v) for v in r))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_from(buf, table, columns=columns)
+
+def get_price_tables(cursor):
+    # every table carrying the daily price columns, except the long-format
+    # ones and the adjusted prices derived from them
+    cmd = 'select table_name, array_agg(column_name::text) from information_schema.columns where table_schema = current_schema() group by table_name having array_agg(column_name::text) @> array[\'date\', \'open\', \'high\', \'low\', \'close\']'
+    cursor.execute(cmd)
+    tables = []
+    for row in cursor.fetchall():
+        if row[0] in ('daily_price', 'adjusted_price', 'macro_price') or row[0].startswith('daily_price_'):
+            continue
+        tables.append((row[0], set(row[1])))
+
+    return sorted(tables)
+
+def date_key_tables(cursor, names):
+    # the tables among names with a unique index on date alone
+    if not names:
+        return set()
+
+    cmd = 'select c.relname from pg_index i join pg_class c on c.oid = i.indrelid join pg_attribute a on a.attrelid = i.indrelid and a.attnum = i.indkey[0] where c.relnamespace = current_schema()::regnamespace and c.relname in %s and i.indisunique and i.indnatts = 1 and a.attname = \'date\''
+    cursor.execute(cmd, (tuple(names),))
+
+    return set(row[0] for row in cursor.fetchall())
+
+def add_date_key(cursor, tbl_name):
+    # keep one row per date, the one with valid prices where the table has them
+    cmd = 'select column_name::text from information_schema.columns where table_schema = current_schema() and table_name = %s'
+    cursor.execute(cmd, (tbl_name,))
+    columns = set(row[0] for row in cursor.fetchall())
+    if set(['open', 'high', 'low', 'close']) <= columns:
+        prefer = '( open > 0 and high > 0 and low > 0 and close > 0 ) desc nulls last, '
+    else:
+        prefer = ''
+
+    table = ident(tbl_name)
+    cursor.execute(sql.SQL('delete from {} where date is null').format(table))
+    removed = cursor.rowcount
+    cmd = sql.SQL('delete from {t} where ctid in ( select ctid from ( select ctid, row_number() over ( partition by date order by {prefer}ctid desc ) as n from {t} ) d where n > 1 )').format(t=table, prefer=sql.SQL(prefer))
+    cursor.execute(cmd)
+    removed += cursor.rowcount
+    cursor.execute(sql.SQL('alter table {} add primary key ( date )').format(table))
+
+    return removed
+
+def ensure_date_keys(cursor, names):
+    # tables written before date became the key are deduplicated and keyed once
+    names = set(names)
+    for tbl_name in sorted(names - date_key_tables(cursor, names)):
+        add_date_key(cursor, tbl_name)
+
+# long-format storage: every ticker in one table partitioned by year
+PRICE_COLUMNS = ('stockno', 'date', 'traded_share', 'open', 'high', 'low', 'close')
+
+def create_daily_price(cursor):
+    cmd = 'create table if not exists daily_price ( stockno text not null, date date not null, traded_share bigint, open real, high real, low real, close real, f_trade integer, l_trade integer, primary key ( stockno, date ) ) partition by range ( date )'
+    cursor.execute(cmd)
+
+def ensure_partitions(cursor, years):
+    for year in sorted(set(int(y) for y in years)):
+        cmd = 'create table if not exists daily_price_%d partition of daily_price for values from ( \'%d-01-01\' ) to ( \'%d-01-01\' )' % (year, year, year + 1)
+        cursor.execute(cmd)
+
+def copy_daily_price(cursor, records, overwrite=False):
+    # records are tuples laid out as PRICE_COLUMNS, date as YYYYMMDD
+    if not records:
+        return 0
+
+    create_daily_price(cursor)
+    ensure_partitions(cursor, (r[1][:4] for r in records))
+
+    cursor.execute('create temp table if not exists price_stage ( stockno text, date date, traded_share bigint, open real, high real, low real, close real ) on commit delete rows')
+
+    copy_rows(cursor, 'price_stage', PRICE_COLUMNS, records)
+
+    if overwrite:
+        conflict = 'do update set ( traded_share, open, high, low, close ) = ( excluded.traded_share, excluded.open, excluded.high, excluded.low, excluded.close )'
+    else:
+        # only replace rows that were stored without valid prices
+        conflict = 'do update set ( traded_share, open, high, low, close ) = ( excluded.traded_share, excluded.open, excluded.high, excluded.low, excluded.close ) where not ( daily_price.open > 0 and daily_price.high > 0 and daily_price.low > 0 and daily_price.close > 0 )'
+
+    cmd = 'insert into daily_price ( %s ) select distinct on ( stockno, date ) %s from price_stage order by stockno, date on conflict ( stockno, date ) %s' % (', '.join(PRICE_COLUMNS), ', '.join(PRICE_COLUMNS), conflict)
+    cursor.execute(cmd)
+    count = cursor.rowcount
+    cursor.execute('truncate price_stage')
+
+    return count
+
+# the macro series (DEBY, DXY, ...) in long format, kept out of daily_price
+# so only exchange tickers count as trading days there
+MACRO_COLUMNS = ('stockno', 'date', 'volume', 'open', 'high', 'low', 'close')
+
+def create_macro_price(cursor):
+    cmd = 'create table if not exists macro_price ( stockno text not null, date date not null, volume bigint, open real, high real, low real, close real, primary key ( stockno, date ) )'
+    cursor.execute(cmd)
+
+def copy_macro_price(cursor, records):
+    # records are tuples laid out as MACRO_COLUMNS, a newer page replaces the stored row
+    if not records:
+        return 0
+
+    create_macro_price(cursor)
+    cursor.execute('create temp table if not exists macro_stage ( like macro_price ) on commit delete rows')
+    copy_rows(cursor, 'macro_stage', MACRO_COLUMNS, records)
+    updates = ', '.join('%s = excluded.%s' % (c, c) for c in MACRO_COLUMNS[2:])
+    cmd = 'insert into macro_price select distinct on ( stockno, date ) * from macro_stage order by stockno, date on conflict ( stockno, date ) do update set %s' % updates
+    cursor.execute(cmd)
+    count = cursor.rowcount
+    cursor.execute('truncate macro_stage')
+
+    return count
+
+def move_macro_price(cursor, names):
+    # rows older runs wrote to daily_price for the macro series in names
+    cursor.execute('select to_regclass(\'daily_price\') is not null')
+    if not cursor.fetchone()[0]:
+        return 0
+
+    create_macro_price(cursor)
+    cmd = 'with moved as ( delete from daily_price where stockno = any(%s) returning stockno, date, traded_share, open, high, low, close ) insert into macro_price select * from moved on conflict ( stockno, date ) do nothing'
+    cursor.execute(cmd, (list(names),))
+
+    return cursor.rowcount
+
+def stage_trade(cursor, date, values):
+    # values are ( stockno, f_trade, l_trade ) tuples for one date
+    cursor.execute('create temp table if not exists trade_stage ( stockno text, date date, f_trade integer, l_trade integer ) on commit delete rows')
+    cursor.execute('truncate trade_stage')
+    copy_rows(cursor, 'trade_stage', ('stockno', 'date', 'f_trade', 'l_trade'),
+              ((v[0], date, v[1], v[2]) for v in values))
@@ -1,72 +1,110 @@
 #!/usr/bin/env python
 
 import sys
+import csv
 import traceback
-import requests
+import datetime
+import numpy as np
+import fxrates
 
 
 def parser():
     import argparse
 
     parser = argparse.ArgumentParser(description='Rate of return of foreign currency')
-    parser.add_argument('invest', type=float, help='Investment (NT dolloar)')
+    parser.add_argument('invest', type=float, nargs='?', help='Investment (NT dolloar)')
     parser.add_argument('--base', type=str, default='TWD', help='The base currency (ex. TWD)')
     parser.add_argument('-u', '--usd', type=float, nargs=1, help='Having U.S. currency')
     parser.add_argument('-a', '--aud', type=float, nargs=1, help='Having Australia currency')
     parser.add_argument('-e', '--eur', type=float, nargs=1, help='Having European currency')
     parser.add_argument('-c', '--cny', type=float, nargs=1, help='Having Chinese currency')
     parser.add_argument('-j', '--jpy', type=float, nargs=1, help='Having Japan currency')
+    parser.add_argument('--db', type=str, help='DB keeping daily rate snapshots (ex. stock)')
+    parser.add_argument('-d', '--date', type=str, help='Use the stored rates of this date, format YYYYMMDD')
+    parser.add_argument('--ttl', type=int, default=3600, help='Seconds the latest rates are reused before fetching again')
+    parser.add_argument('-H', '--holdings', type=str, help='CSV of lots with columns account,currency,amount,invest (invest in base currency)')
 
     return parser
 
-def fcurrencyrates(base):
-    url = 'https://v3.exchangerate-api.com/bulk/deee1f1aa64988a61cce9d1e/%s' % base
-
-    page = requests.get(url)
-
-    if not page.ok:
-        page.raise_for_status()
-
-    content = page.json()
-
-    try:
-        rates = content['rates']
-    except KeyError as e:
-        raise KeyError('No \'rates\' key contained')
-
-    return rates
+def fcurrencyrates(base, dbname=None, date=None, ttl=3600):
+    # cached latest rates, or the stored snapshot for date
+    return fxrates.RateStore(dbname, ttl=ttl).rates(base, date)
+
+def read_holdings(path):
+    accounts = []
+    currencies = []
+    amounts = []
+    invests = []
+
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            accounts.append(row['account'].strip())
+            currencies.append(row['currency'].strip().upper())
+            amounts.append(float(row['amount']))
+            invests.append(float(row['invest']))
+
+    return {'account': np.array(accounts), 'currency': np.array(currencies),
+            'amount': np.array(amounts), 'invest': np.array(invests)}
+
+def value_holdings(holdings, rates):
+    # one lookup per distinct currency, then every lot in a single division
+    codes, index = np.unique(holdings['currency'], return_inverse=True)
+    missing = [c for c in codes if c not in rates]
+    if missing:
+        raise KeyError('No rate for %s' % ', '.join(missing))
+
+    code_rates = np.array([rates[c] for c in codes], dtype=np.float64)
+    back = holdings['amount'] / code_rates[index]
+
+    # sum lots per account
+    names, account = np.unique(holdings['account'], return_inverse=True)
+    invest = np.bincount(account, weights=holdings['invest'], minlength=len(names))
+    back = np.bincount(account, weights=back, minlength=len(names))
+    revenue = back - invest
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate_of_return = revenue / invest * 100
+
+    return {'account': names, 'invest': invest, 'back': back,
+            'revenue': revenue, 'return': rate_of_return}
+
+def print_table(result):
+    print('%-16s %14s %14s %14s %10s' % ('Account', 'Investment', 'Exchange back', 'Revenue', 'Return'))
+    for i in range(len(result['account'])):
+        print('%-16s %14.2f %14.3f %14.3f %9.3f%%' % (result['account'][i], result['invest'][i],
+              result['back'][i], result['revenue'][i], result['return'][i]))
+
+    invest = result['invest'].sum()
+    revenue = result['revenue'].sum()
+    print('%-16s %14.2f %14.3f %14.3f %9.3f%%' % ('Total', invest, result['back'].sum(),
+          revenue, revenue / invest * 100 if invest else float('nan')))
 
 def main(argv):
     args = parser().parse_args(argv[1:])
 
-    rates = fcurrencyrates(args.base)
-
-    if args.usd:
-        usd_e = args.usd[0]/rates['USD']
-    else:
-        usd_e = 0
+    if args.holdings is None and args.invest is None:
+        parser().error('either invest or --holdings is required')
 
-    if args.aud:
-        aud_e = args.aud[0]/rates['AUD']
-    else:
-        aud_e = 0
+    date = None
+    if args.date:
+        date = datetime.datetime.strptime(args.date, '%Y%m%d').date()
 
-    if args.eur:
-        eur_e = args.eur[0]/rates['EUR']
-    else:
-        eur_e = 0
+    rates = fcurrencyrates(args.base, args.db, date, args.ttl)
 
-    if args.cny:
-        cny_e = args.cny[0]/rates['CNY']
-    else:
-        cny_e = 0
+    if args.holdings:
+        print_table(value_holdings(read_holdings(args.holdings), rates))
+        return
 
-    if args.jpy:
-        jpy_e = args.jpy[0]/rates['JPY']
-    else:
-        jpy_e = 0
+    currencies = []
+    amounts = []
+    for code, amount in [('USD', args.usd), ('AUD', args.aud), ('EUR', args.eur),
+                         ('CNY', args.cny), ('JPY', args.jpy)]:
+        if amount:
+            currencies.append(code)
+            amounts.append(amount[0])
 
-    total_back = usd_e + aud_e + jpy_e + cny_e + eur_e
+    holdings = {'account': np.array(['-'] * len(currencies)), 'currency': np.array(currencies, dtype=str),
+                'amount': np.array(amounts, dtype=np.float64), 'invest': np.zeros(len(currencies))}
+    total_back = value_holdings(holdings, rates)['back'].sum()
     revenue = total_back - args.invest
     rate_of_return = revenue/args.invest*100
 
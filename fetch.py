@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+import re
+import json
+import time
+import codecs
+import itertools
+import logging
+import threading
+import requests
+from urllib.parse import urlsplit
+import metrics
+
+# investing.com and yahoo turn away clients that don't look like a browser
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.113 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.8',
+}
+
+# the object's own punctuation, every member value is left to the C decoder
+OPEN = re.compile(r'\s*\{')
+MEMBER = re.compile(r'\s*(?:("(?:[^"\\]|\\.)*")\s*:\s*|(\}))', re.S)
+NEXT = re.compile(r'\s*([,}])')
+SPACE = re.compile(r'\s*')
+DECODER = json.JSONDecoder()
+
+def json_members(chunks, keys):
+    # values of the wanted top-level keys of a JSON object arriving as text
+    # chunks; only the member being read is buffered, the rest are decoded
+    # and dropped as they stream by
+    keys = set(keys)
+    found = {}
+    buf = ''
+    need = 0
+    step = 'open'
+    key = None
+
+    for chunk in itertools.chain(chunks, [None]):
+        last = chunk is None
+        if not last:
+            buf += chunk
+            if len(buf) < need:
+                continue
+
+        pos = 0
+        while step != 'done':
+            if step == 'value':
+                pos = SPACE.match(buf, pos).end()
+                try:
+                    value, end = DECODER.raw_decode(buf, pos)
+                except ValueError:
+                    end = None
+                # a number cut by the chunk or body still decodes, the member must be closed too
+                if end is None or not NEXT.match(buf, end):
+                    # retry once the buffer doubled, a long member isn't decoded every chunk
+                    need = 2 * (len(buf) - pos)
+                    break
+                if key in keys:
+                    found[key] = value
+                need = 0
+                pos = end
+                step = 'done' if len(found) == len(keys) else 'next'
+                continue
+
+            if step == 'open':
+                m = OPEN.match(buf, pos)
+                if not m and buf[pos:].strip():
+                    raise ValueError('Not a JSON object')
+            else:
+                m = (MEMBER if step == 'member' else NEXT).match(buf, pos)
+            if not m:
+                break
+            pos = m.end()
+
+            if step == 'open' or (step == 'next' and m.group(1) == ','):
+                step = 'member'
+            elif step == 'member' and m.group(1):
+                key = json.loads(m.group(1))
+                step = 'value'
+            else:
+                step = 'done'
+
+        buf = buf[pos:]
+        if step == 'done':
+            break
+    else:
+        raise ValueError('Truncated JSON object')
+
+    return found
+
+class PageFetcher(object):
+    def __init__(self, per_host=2, timeout=30, retries=0, phantomjs='/usr/bin/phantomjs'):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.phantomjs = phantomjs
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=per_host * 4)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.driver = None
+        self.driver_lock = threading.Lock()
+
+    def host_slot(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.Semaphore(self.per_host)
+            return self.hosts[host]
+
+    def retry(self, url, func, *args):
+        # retry with exponential backoff, None once every attempt failed
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+
+            with self.host_slot(url):
+                result = func(*args)
+
+            if result is not None:
+                return result
+
+        return None
+
+    def get(self, url, js=False, binary=False):
+        if js:
+            return self.retry(url, self.get_rendered, url)
+
+        return self.retry(url, self.get_plain, url, binary)
+
+    def get_members(self, url, params, keys):
+        # dict of the wanted top-level keys of a JSON reply, missing keys left out
+        return self.retry(url, self.stream_members, url, params, keys)
+
+    def stream_members(self, url, params, keys):
+        host = urlsplit(url).netloc
+        start = time.time()
+        try:
+            page = self.session.get(url, params=params, timeout=self.timeout, stream=True)
+        except requests.RequestException as e:
+            metrics.inc('http_requests', source=host, status='error')
+            logging.error('Can\'t get %s: %s' % (url, e))
+            return None
+
+        try:
+            if not page.ok:
+                logging.error('Can\'t get %s: %s' % (page.url, page.reason))
+                return None
+
+            decoder = codecs.getincrementaldecoder(page.encoding or 'utf-8')('replace')
+            chunks = page.iter_content(1 << 16)
+            found = json_members((decoder.decode(c) for c in chunks), keys)
+            # drain the rest so the connection goes back to the pool
+            for c in chunks:
+                pass
+            return found
+        except (requests.RequestException, ValueError) as e:
+            logging.error('Can\'t read %s: %s' % (page.url, e))
+            return None
+        finally:
+            metrics.observe('http', time.time() - start, source=host)
+            metrics.inc('http_requests', source=host, status=str(page.status_code))
+            metrics.inc('http_bytes', page.raw.tell(), source=host)
+            page.close()
+
+    def get_plain(self, url, binary=False):
+        host = urlsplit(url).netloc
+        start = time.time()
+        try:
+            page = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            metrics.inc('http_requests', source=host, status='error')
+            logging.error('Can\'t get %s: %s' % (url, e))
+            return None
+        finally:
+            metrics.observe('http', time.time() - start, source=host)
+
+        metrics.inc('http_requests', source=host, status=str(page.status_code))
+        metrics.inc('http_bytes', len(page.content), source=host)
+
+        if not page.ok:
+            logging.error('Can\'t get %s: %s' % (url, page.reason))
+            return None
+
+        return page.content if binary else page.text
+
+    def get_rendered(self, url):
+        # one browser for every page that needs JS, started on first use
+        with self.driver_lock:
+            if self.driver is None:
+                from selenium import webdriver
+                self.driver = webdriver.PhantomJS(executable_path=self.phantomjs)
+                self.driver.set_page_load_timeout(self.timeout)
+
+            try:
+                with metrics.timer('http', source=urlsplit(url).netloc, js=True):
+                    self.driver.get(url)
+                return self.driver.page_source
+            except Exception as e:
+                logging.error('html retrieve failed: %s: %s' % (url, e))
+                return None
+
+    def close(self):
+        self.session.close()
+        with self.driver_lock:
+            if self.driver is not None:
+                self.driver.quit()
+                self.driver = None
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+import sys
+import traceback
+import json
+import gzip
+import math
+import time
+import random
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# Stand-in for twse.com.tw, tpex.org.tw, treasury.gov, investing.com and yahoo. Responses
+# are synthesized per date with the same layout as the real pages, and the
+# same date always yields the same numbers.
+
+YIELD_TAGS = ['BC_1MONTH', 'BC_3MONTH', 'BC_6MONTH', 'BC_1YEAR', 'BC_2YEAR', 'BC_3YEAR',
+              'BC_5YEAR', 'BC_7YEAR', 'BC_10YEAR', 'BC_20YEAR', 'BC_30YEAR']
+
+def parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve synthetic TWSE/TPEx/Treasury/investing/yahoo pages')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('-n', '--stocks', type=int, default=1000, help='Number of stocks per trading day')
+    parser.add_argument('-d', '--date', type=str, default='20170621', help='Last date of the history pages, format YYYYMMDD')
+    parser.add_argument('--days', type=int, default=30, help='Number of days in the history pages')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds every reply is held back, ex. 0.3 to mimic TWSE')
+
+    return parser
+
+def is_trading_day(dt):
+    return dt.weekday() < 5
+
+def stock_numbers(stocks):
+    return ['%04d' % (1101 + i) for i in range(stocks)]
+
+def otc_numbers(stocks):
+    # TPEx listings don't share numbers with TWSE ones
+    return ['%04d' % (5201 + i) for i in range(stocks)]
+
+def roc_date(text):
+    # 106/06/21 -> 20170621
+    year, month, day = text.split('/')
+    return datetime.datetime(int(year) + 1911, int(month), int(day))
+
+def price_of(seed, dt):
+    # deterministic wave plus noise so consecutive days look like a series
+    rng = random.Random('%s%s' % (seed, dt.strftime('%Y%m%d')))
+    base = 10 + (hash_str(seed) % 500)
+    close = base * (1 + 0.2 * math.sin(dt.toordinal() / 20.0 + hash_str(seed)))
+    close = round(close * (1 + rng.uniform(-0.01, 0.01)), 2)
+    open_p = round(close * (1 + rng.uniform(-0.02, 0.02)), 2)
+    high_p = round(max(open_p, close) * (1 + rng.uniform(0, 0.02)), 2)
+    low_p = round(min(open_p, close) * (1 - rng.uniform(0, 0.02)), 2)
+    volume = rng.randint(1000, 50000000)
+
+    return rng, open_p, high_p, low_p, close, volume
+
+def hash_str(s):
+    h = 0
+    for c in s:
+        h = (h * 131 + ord(c)) % 1000003
+    return h
+
+def history_dates(end, days):
+    dt = end
+    while days > 0:
+        if is_trading_day(dt):
+            yield dt
+            days -= 1
+        dt -= datetime.timedelta(1)
+
+def mi_index(dt, stocks):
+    if not is_trading_day(dt):
+        return {'stat': '很抱歉，沒有符合條件的資料!'}
+
+    data5 = []
+    for i, stockno in enumerate(stock_numbers(stocks)):
+        rng, open_p, high_p, low_p, close_p, volume = price_of(stockno, dt)
+        if i % 97 == 96:
+            # suspended stock, TWSE reports '--' for prices
+            prices = ['--', '--', '--', '--']
+        else:
+            prices = ['%.2f' % p for p in (open_p, high_p, low_p, close_p)]
+        data5.append([stockno, 'Stock %s' % stockno, '{:,}'.format(volume),
+                      '{:,}'.format(volume // 1000 + 1), '{:,}'.format(int(volume * close_p))] +
+                     prices + ['<p style= color:red>+</p>', '0.10', prices[3], '10', prices[3], '5', '12.34'])
+
+    # type=ALL also carries the index tables around data5, notes quote brackets
+    data1 = [['Index %d' % i, '{:,.2f}'.format(8000 + i), '<p style ="color:red">+</p>', '12.34', '0.15'] for i in range(60)]
+    fields5 = ['證券代號', '證券名稱', '成交股數', '成交筆數', '成交金額', '開盤價', '最高價', '最低價', '收盤價',
+               '漲跌(+/-)', '漲跌價差', '最後揭示買價', '最後揭示買量', '最後揭示賣價', '最後揭示賣量', '本益比']
+    notes5 = ['漲跌(+/-)欄位符號說明:+/-/X表示漲/跌/不比價。', 'see "[data5]" and {fields5}\\']
+
+    return {'stat': 'OK', 'date': dt.strftime('%Y%m%d'), 'fields1': fields5[:5], 'data1': data1,
+            'fields5': fields5, 'data5': data5, 'notes5': notes5,
+            'data6': [['%d' % i, '{:,}'.format(i * 1000)] for i in range(20)], 'params': {'type': 'ALL'}}
+
+def t86(dt, stocks):
+    if not is_trading_day(dt):
+        return {'stat': '很抱歉，沒有符合條件的資料!'}
+
+    data = []
+    for stockno in stock_numbers(stocks):
+        rng = random.Random('t86%s%s' % (stockno, dt.strftime('%Y%m%d')))
+        nums = [rng.randint(0, 5000000) for i in range(6)]
+        row = [stockno, 'Stock %s' % stockno]
+        row += ['{:,}'.format(n) for n in (nums[0], nums[1], nums[0] - nums[1])]
+        row += ['{:,}'.format(n) for n in (nums[2], nums[3], nums[2] - nums[3])]
+        row += ['{:,}'.format(nums[4] - nums[5])] + ['0'] * 7
+        row += ['{:,}'.format(nums[0] - nums[1] + nums[2] - nums[3] + nums[4] - nums[5])]
+        data.append(row)
+
+    return {'stat': 'OK', 'date': dt.strftime('%Y%m%d'), 'data': data}
+
+def tpex_quotes(dt, stocks):
+    # closed days still answer, just without rows
+    roc = '%d/%s' % (dt.year - 1911, dt.strftime('%m/%d'))
+    if not is_trading_day(dt):
+        return {'reportDate': roc, 'iTotalRecords': 0, 'aaData': []}
+
+    data = []
+    for i, stockno in enumerate(otc_numbers(stocks)):
+        rng, open_p, high_p, low_p, close_p, volume = price_of(stockno, dt)
+        if i % 89 == 88:
+            # no trade that day, TPEx reports '---' for prices
+            prices = ['---', '---', '---', '---']
+        else:
+            prices = ['%.2f' % p for p in (close_p, open_p, high_p, low_p)]
+        data.append([stockno, 'OTC %s' % stockno, prices[0], '+0.10'] + prices[1:] + ['%.2f' % close_p, '{:,}'.format(volume),
+                     '{:,}'.format(int(volume * close_p)), '{:,}'.format(volume // 1000 + 1), prices[0], prices[0],
+                     '{:,}'.format(volume * 10), prices[0], prices[0], prices[0]])
+
+    return {'reportDate': roc, 'iTotalRecords': len(data), 'aaData': data,
+            'mmData': [['Index', '123.45']], 'reportTitle': '上櫃股票行情'}
+
+def tpex_trades(dt, stocks):
+    roc = '%d/%s' % (dt.year - 1911, dt.strftime('%m/%d'))
+    if not is_trading_day(dt):
+        return {'reportDate': roc, 'iTotalRecords': 0, 'aaData': []}
+
+    data = []
+    for stockno in otc_numbers(stocks):
+        rng = random.Random('tpex%s%s' % (stockno, dt.strftime('%Y%m%d')))
+        nums = [rng.randint(0, 2000000) for i in range(6)]
+        row = [stockno, 'OTC %s' % stockno]
+        row += ['{:,}'.format(n) for n in (nums[0], nums[1], nums[0] - nums[1])]
+        row += ['{:,}'.format(n) for n in (nums[2], nums[3], nums[2] - nums[3])]
+        row += ['{:,}'.format(nums[4] - nums[5])] + ['0'] * 6
+        row += ['{:,}'.format(nums[0] - nums[1] + nums[2] - nums[3] + nums[4] - nums[5])]
+        data.append(row)
+
+    return {'reportDate': roc, 'iTotalRecords': len(data), 'aaData': data}
+
+def yield_xml(end, days):
+    out = ['<?xml version="1.0" encoding="UTF-8"?>', '<LIST_G_WEEK_OF_MONTH><G_WEEK_OF_MONTH><LIST_G_NEW_DATE>']
+    for dt in reversed(list(history_dates(end, days))):
+        rng = random.Random('usty%s' % dt.strftime('%Y%m%d'))
+        out.append('<G_NEW_DATE><BID_CURVE_DATE>%s</BID_CURVE_DATE><LIST_G_BC_CAT><G_BC_CAT>' % dt.strftime('%d-%b-%y').upper())
+        for i, tag in enumerate(YIELD_TAGS):
+            out.append('<%s>%.2f</%s>' % (tag, 0.8 + i * 0.2 + rng.uniform(-0.05, 0.05), tag))
+        out.append('</G_BC_CAT></LIST_G_BC_CAT></G_NEW_DATE>')
+    out.append('</LIST_G_NEW_DATE></G_WEEK_OF_MONTH></LIST_G_WEEK_OF_MONTH>')
+
+    return '\n'.join(out)
+
+def investing_html(name, end, days, table_attrs, tbody_attrs):
+    out = ['<html><body><table %s><thead><tr><th>Date</th><th>Price</th><th>Open</th><th>High</th><th>Low</th><th>Change %%</th></tr></thead>' % table_attrs,
+           '<tbody %s>' % tbody_attrs]
+    for dt in history_dates(end, days):
+        rng, open_p, high_p, low_p, close_p, volume = price_of(name, dt)
+        out.append('<tr>\n<td>%s</td>\n<td>{:,.2f}</td>\n<td>{:,.2f}</td>\n<td>{:,.2f}</td>\n<td>{:,.2f}</td>\n<td>0.00%%</td>\n</tr>'.format(close_p, open_p, high_p, low_p) % dt.strftime('%b %d, %Y'))
+    out.append('</tbody></table></body></html>')
+
+    return '\n'.join(out)
+
+def yahoo_html(name, end, days):
+    rows = []
+    for dt in history_dates(end, days):
+        rng, open_p, high_p, low_p, close_p, volume = price_of(name, dt)
+        cells = [dt.strftime('%b %d, %Y')] + ['%.2f' % p for p in (open_p, high_p, low_p, close_p, close_p)] + ['{:,}'.format(volume)]
+        rows.append('<tr class="BdT">%s</tr>' % ''.join('<td><span>%s</span></td>' % c for c in cells))
+
+    return '<html><body><table><tbody>%s</tbody></table></body></html>' % ''.join(rows)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        srv = self.server
+
+        try:
+            if parts.path == '/exchangeReport/MI_INDEX':
+                dt = datetime.datetime.strptime(query['date'][0], '%Y%m%d')
+                self.reply(json.dumps(mi_index(dt, srv.stocks)), 'application/json')
+            elif parts.path == '/fund/T86':
+                dt = datetime.datetime.strptime(query['date'][0], '%Y%m%d')
+                self.reply(json.dumps(t86(dt, srv.stocks)), 'application/json')
+            elif parts.path == '/web/stock/aftertrading/daily_close_quotes/stk_quote_result.php':
+                self.reply(json.dumps(tpex_quotes(roc_date(query['d'][0]), srv.stocks)), 'application/json')
+            elif parts.path == '/web/stock/3insti/daily_trade/3itrade_hedge_result.php':
+                self.reply(json.dumps(tpex_trades(roc_date(query['d'][0]), srv.stocks)), 'application/json')
+            elif parts.path.endswith('/yield.xml'):
+                self.reply(yield_xml(srv.end, srv.days), 'application/xml')
+            elif parts.path == '/indices/usdollar-historical-data':
+                self.reply(investing_html('DXY', srv.end, srv.days, 'class="instHistoryTbl"', 'class="js-history-data"'), 'text/html')
+            elif parts.path.endswith('-historical-data'):
+                self.reply(investing_html(parts.path, srv.end, srv.days, 'class="genTbl closedTbl historicalTbl"', ''), 'text/html')
+            elif parts.path.startswith('/quote/'):
+                self.reply(yahoo_html(parts.path.split('/')[2], srv.end, srv.days), 'text/html')
+            else:
+                self.send_error(404)
+        except (KeyError, ValueError) as e:
+            self.send_error(400, str(e))
+
+    def reply(self, body, content_type):
+        time.sleep(self.server.latency)
+        body = body.encode('utf-8')
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', '%s; charset=utf-8' % content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(port=0, stocks=1000, end='20170621', days=30, latency=0):
+    srv = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    srv.daemon_threads = True
+    srv.stocks = stocks
+    srv.end = datetime.datetime.strptime(end, '%Y%m%d')
+    srv.days = days
+    srv.latency = latency
+
+    return srv
+
+def start_server(port=0, stocks=1000, end='20170621', days=30, latency=0):
+    # serve from a background thread, returns the server and its base url
+    srv = make_server(port, stocks, end, days, latency)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+
+    return srv, 'http://127.0.0.1:%d' % srv.server_address[1]
+
+def main(argv):
+    args = parser().parse_args(argv[1:])
+
+    srv = make_server(args.port, args.stocks, args.date, args.days, args.latency)
+    print('Serving on http://127.0.0.1:%d' % srv.server_address[1])
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    srv.server_close()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit(1)
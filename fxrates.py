@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import datetime
+import requests
+import db
+
+# Exchange rates from exchangerate-api. The latest rates per base currency
+# are kept in a small JSON file for ttl seconds so repeated runs don't spend
+# API quota, and every fetch is saved as that day's snapshot in the fx_rates
+# table, next to USTY and DXY, for historical lookups.
+
+API_URL = 'https://v3.exchangerate-api.com/bulk/deee1f1aa64988a61cce9d1e/%s'
+
+def fetch_rates(base):
+    page = requests.get(API_URL % base)
+
+    if not page.ok:
+        page.raise_for_status()
+
+    content = page.json()
+
+    try:
+        rates = content['rates']
+    except KeyError as e:
+        raise KeyError('No \'rates\' key contained')
+
+    return rates
+
+def create_fx_rates(cursor):
+    cmd = 'create table if not exists fx_rates ( date date not null, base text not null, currency text not null, rate float8 not null, primary key ( date, base, currency ) )'
+    cursor.execute(cmd)
+
+class RateStore(object):
+    def __init__(self, dbname=None, cache_dir='cache', ttl=3600, fetch=fetch_rates):
+        self.dbname = dbname
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.fetch = fetch
+
+    def cache_file(self, base):
+        return os.path.join(self.cache_dir, 'rates_%s.json' % base)
+
+    def cached(self, base):
+        path = self.cache_file(base)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, ValueError) as e:
+            return None
+
+        if time.time() - entry['time'] > self.ttl:
+            return None
+
+        return entry['rates']
+
+    def latest(self, base):
+        rates = self.cached(base)
+        if rates is not None:
+            return rates
+
+        rates = self.fetch(base)
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self.cache_file(base)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'time': time.time(), 'rates': rates}, f)
+        os.replace(path + '.tmp', path)
+
+        if self.dbname:
+            self.save(base, datetime.date.today(), rates)
+
+        return rates
+
+    def save(self, base, date, rates):
+        # one snapshot per day, a later fetch the same day replaces it
+        with db.connection(self.dbname) as conn:
+            cursor = conn.cursor()
+            create_fx_rates(cursor)
+            cmd = 'insert into fx_rates values %s on conflict ( date, base, currency ) do update set rate = excluded.rate'
+            db.execute_values(cursor, cmd, [(date, base, currency, rate) for currency, rate in sorted(rates.items())])
+            conn.commit()
+
+    def historical(self, base, date):
+        # newest stored rate of each currency on or before date, crossed through
+        # another base when base itself was never fetched
+        if not self.dbname:
+            raise KeyError('No database to look up %s rates of %s' % (base, date))
+
+        with db.connection(self.dbname) as conn:
+            cursor = conn.cursor()
+            create_fx_rates(cursor)
+            cmd = 'select distinct on ( base, currency ) base, currency, rate from fx_rates where date <= %s order by base, currency, date desc'
+            cursor.execute(cmd, (date,))
+            snapshots = {}
+            for row in cursor.fetchall():
+                snapshots.setdefault(row[0], {})[row[1]] = row[2]
+            conn.commit()
+
+        if base in snapshots:
+            return snapshots[base]
+
+        for other, rates in sorted(snapshots.items()):
+            if rates.get(base):
+                return dict((c, r / rates[base]) for c, r in rates.items())
+
+        raise KeyError('No %s rates on or before %s' % (base, date))
+
+    def rates(self, base, date=None):
+        if date is None:
+            return self.latest(base)
+
+        return self.historical(base, date)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import sys
+import datetime
+import traceback
+import logging
+import numpy as np
+import db
+import stock
+
+# Technical indicators materialized in the indicators table, one row per
+# ( stockno, date ). The rolling state each indicator needs (last closes,
+# Wilder averages, streaks) is kept in indicator_state, so a daily run only
+# reads the days after each ticker's state date. Every step works on all
+# tickers at once, one date column at a time. A ticker whose newest day has
+# no T86 yet keeps the state of the day before, so the next run reads that
+# day again and its streaks come in along with the T86.
+
+WINDOW = 60
+MA_DAYS = (5, 20, 60)
+RSI_DAYS = 14
+INDICATOR_COLUMNS = ('stockno', 'date', 'ma5', 'ma20', 'ma60', 'rsi14', 'f_streak', 'l_streak')
+STATE_COLUMNS = ('stockno', 'date', 'count', 'closes', 'avg_gain', 'avg_loss', 'f_streak', 'l_streak')
+STATE_ATTRS = ('since', 'count', 'closes', 'avg_gain', 'avg_loss', 'f_streak', 'l_streak')
+
+def parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Update the materialized technical indicators')
+    parser.add_argument('dbname', type=str, help='DB name to operate')
+    parser.add_argument('-d', '--date', type=str, help='Last date to compute, format YYYYMMDD (default today)')
+    parser.add_argument('--backfill', action='store_true', help='Drop the saved state and rebuild every indicator from the full history')
+    parser.add_argument('-b', '--batch', type=int, default=200, help='Tables read per query')
+
+    return parser
+
+def create_tables(cursor):
+    cmd = 'create table if not exists indicators ( stockno text not null, date date not null, ma5 real, ma20 real, ma60 real, rsi14 real, f_streak integer, l_streak integer, primary key ( stockno, date ) )'
+    cursor.execute(cmd)
+    cmd = 'create table if not exists indicator_state ( stockno text primary key, date date not null, count integer not null, closes float8[] not null, avg_gain float8, avg_loss float8, f_streak integer not null, l_streak integer not null )'
+    cursor.execute(cmd)
+
+class State(object):
+    def __init__(self, stocknos):
+        n = len(stocknos)
+        self.stocknos = stocknos
+        self.since = np.full(n, np.datetime64('1900-01-01'), dtype='datetime64[D]')
+        self.count = np.zeros(n, dtype=np.int64)
+        self.closes = np.full((n, WINDOW), np.nan)
+        self.avg_gain = np.zeros(n)
+        self.avg_loss = np.zeros(n)
+        self.f_streak = np.zeros(n, dtype=np.int64)
+        self.l_streak = np.zeros(n, dtype=np.int64)
+        self.touched = np.zeros(n, dtype=bool)
+        # the state before each ticker's newest day, and whether that day
+        # still waits for its T86
+        self.before = None
+        self.pending = np.zeros(n, dtype=bool)
+
+    def load(self, cursor):
+        index = dict((s, i) for i, s in enumerate(self.stocknos))
+        cursor.execute('select %s from indicator_state' % ', '.join(STATE_COLUMNS))
+        for row in cursor.fetchall():
+            i = index.get(row[0])
+            if i is None:
+                continue
+            self.since[i] = row[1]
+            self.count[i] = row[2]
+            self.closes[i] = row[3]
+            self.avg_gain[i] = row[4]
+            self.avg_loss[i] = row[5]
+            self.f_streak[i] = row[6]
+            self.l_streak[i] = row[7]
+
+    def remember(self, m):
+        if self.before is None:
+            self.before = dict((a, getattr(self, a).copy()) for a in STATE_ATTRS)
+        for a in STATE_ATTRS:
+            self.before[a][m] = getattr(self, a)[m]
+
+    def rows(self):
+        for i in np.nonzero(self.touched)[0]:
+            st = self.before if self.pending[i] else dict((a, getattr(self, a)) for a in STATE_ATTRS)
+            closes = '{%s}' % ','.join('NaN' if np.isnan(c) else repr(float(c)) for c in st['closes'][i])
+            yield (self.stocknos[i], st['since'][i], st['count'][i], closes,
+                   repr(float(st['avg_gain'][i])), repr(float(st['avg_loss'][i])), st['f_streak'][i], st['l_streak'][i])
+
+def streak(prev, net):
+    # consecutive net buy days count up, net sell days count down
+    up = np.where(prev > 0, prev + 1, 1)
+    down = np.where(prev < 0, prev - 1, -1)
+    return np.where(net > 0, up, np.where(net < 0, down, 0))
+
+def step(state, date, close, f_trade, l_trade):
+    # advance every ticker that traded on date, returns their indicator rows
+    m = ~np.isnan(close) & (date > state.since)
+    if not m.any():
+        return []
+
+    state.remember(m)
+    c = close[m]
+    count = state.count[m]
+    prev = state.closes[m, -1]
+
+    # wilder's smoothing, a plain mean over the first RSI_DAYS changes
+    changes = np.maximum(count, 1)
+    diff = np.where(count > 0, c - prev, 0)
+    n = np.minimum(changes, RSI_DAYS)
+    has_prev = count > 0
+    state.avg_gain[m] += np.where(has_prev, (np.maximum(diff, 0) - state.avg_gain[m]) / n, 0)
+    state.avg_loss[m] += np.where(has_prev, (np.maximum(-diff, 0) - state.avg_loss[m]) / n, 0)
+
+    closes = state.closes[m]
+    closes[:, :-1] = closes[:, 1:]
+    closes[:, -1] = c
+    state.closes[m] = closes
+    count = count + 1
+    state.count[m] = count
+
+    mas = []
+    for days in MA_DAYS:
+        mas.append(np.where(count >= days, closes[:, -days:].mean(axis=1), np.nan))
+
+    gain, loss = state.avg_gain[m], state.avg_loss[m]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi = np.where(loss > 0, 100 - 100 / (1 + gain / loss), np.where(gain > 0, 100.0, 50.0))
+    rsi = np.where(count > RSI_DAYS, rsi, np.nan)
+
+    # a missing T86 row keeps the streak and leaves the day empty
+    streaks = []
+    pending = np.zeros(len(c), dtype=bool)
+    for attr, net in (('f_streak', f_trade[m]), ('l_streak', l_trade[m])):
+        known = ~np.isnan(net)
+        value = getattr(state, attr)[m]
+        value = np.where(known, streak(value, np.nan_to_num(net)), value)
+        getattr(state, attr)[m] = value
+        streaks.append(np.where(known, value, np.nan))
+        pending |= ~known
+    state.pending[m] = pending
+
+    state.since[m] = date
+    state.touched |= m
+
+    rows = []
+    day = date.astype(datetime.date)
+    for j, i in enumerate(np.nonzero(m)[0]):
+        values = [mas[0][j], mas[1][j], mas[2][j], rsi[j]]
+        values = [None if np.isnan(v) else round(float(v), 4) for v in values]
+        values += [None if np.isnan(s[j]) else int(s[j]) for s in streaks]
+        rows.append([state.stocknos[i], day] + values)
+
+    return rows
+
+def write(cursor, rows, state):
+    cursor.execute('create temp table if not exists indicator_stage ( like indicators ) on commit drop')
+    db.copy_rows(cursor, 'indicator_stage', INDICATOR_COLUMNS, rows)
+    updates = ', '.join('%s = excluded.%s' % (c, c) for c in INDICATOR_COLUMNS[2:])
+    cmd = 'insert into indicators select * from indicator_stage on conflict ( stockno, date ) do update set %s' % updates
+    cursor.execute(cmd)
+
+    cursor.execute('create temp table if not exists indicator_state_stage ( like indicator_state ) on commit drop')
+    db.copy_rows(cursor, 'indicator_state_stage', STATE_COLUMNS, state.rows())
+    updates = ', '.join('%s = excluded.%s' % (c, c) for c in STATE_COLUMNS[1:])
+    cmd = 'insert into indicator_state select * from indicator_state_stage on conflict ( stockno ) do update set %s' % updates
+    cursor.execute(cmd)
+
+def update(dbname, end=None, backfill=False, batch=200):
+    # returns the number of indicator rows written
+    end = stock.to_date(end) if end else datetime.date.today()
+    store = stock.Store(dbname)
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        create_tables(cursor)
+        if backfill:
+            cursor.execute('truncate indicators, indicator_state')
+        tables = store.tables(cursor)
+        stocknos = [s for s in store.tickers(cursor) if 'close' in tables.get(s, tables.get('daily_price', ()))]
+        state = State(stocknos)
+        state.load(cursor)
+        conn.commit()
+
+    if not stocknos:
+        return 0
+
+    # tickers sharing a state date are read together, usually that is all of them
+    groups = {}
+    for i, since in enumerate(state.since):
+        groups.setdefault(since, []).append(i)
+
+    rows = []
+    for since, index in sorted(groups.items()):
+        start = (since + np.timedelta64(1, 'D')).astype(datetime.date)
+        frame = store.load([stocknos[i] for i in index], start, end, ('close', 'f_trade', 'l_trade'), batch, cache=False)
+        columns = dict((f, np.full(len(stocknos), np.nan)) for f in frame.fields)
+        for t, date in enumerate(frame.dates):
+            for field, column in columns.items():
+                column[index] = frame[field][:, t]
+            rows.extend(step(state, date, columns['close'], columns['f_trade'], columns['l_trade']))
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        write(cursor, rows, state)
+        conn.commit()
+
+    return len(rows)
+
+def main(argv):
+    args = parser().parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s\t%(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    if args.date:
+        try:
+            datetime.datetime.strptime(args.date, '%Y%m%d')
+        except ValueError as e:
+            logging.error('Invalid Date: %s' % args.date)
+            sys.exit(1)
+
+    rows = update(args.dbname, args.date, args.backfill, args.batch)
+    logging.info('%d indicator rows written' % rows)
+    db.close_all()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+# Counters and timers shared by the ingestion scripts. Anything can call
+# inc()/observe()/timer()/sample() with labels (source, dataset, date, ...), main()
+# dumps the registry as a JSON summary and optionally as a Prometheus
+# textfile for node_exporter's textfile collector. Every script writes its
+# own prefix (stock_updatedb_..., stock_updatetbl_...) so textfiles sharing a
+# collector directory never repeat a series.
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.timers = {}
+            self.samples = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, secs, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += secs
+            timer[2] = max(timer[2], secs)
+
+    def sample(self, name, value, **labels):
+        # a level seen now and then, ex. a queue depth, kept as mean and max
+        key = (name, label_key(labels))
+        with self.lock:
+            stat = self.samples.setdefault(key, [0, 0.0, value])
+            stat[0] += 1
+            stat[1] += value
+            stat[2] = max(stat[2], value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def summary(self):
+        with self.lock:
+            counters = [{'name': k[0], 'labels': dict(k[1]), 'value': v} for k, v in sorted(self.counters.items())]
+            timers = [{'name': k[0], 'labels': dict(k[1]), 'count': v[0], 'seconds': round(v[1], 6), 'max': round(v[2], 6)}
+                      for k, v in sorted(self.timers.items())]
+            samples = [{'name': k[0], 'labels': dict(k[1]), 'count': v[0], 'mean': round(v[1] / v[0], 3), 'max': v[2]}
+                       for k, v in sorted(self.samples.items())]
+
+        return {'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                'elapsed': round(time.time() - self.started, 3), 'counters': counters, 'timers': timers, 'samples': samples}
+
+    def write_json(self, path):
+        text = json.dumps(self.summary(), indent=1, sort_keys=True)
+        if path == '-':
+            print(text)
+            return
+
+        write_atomic(path, text + '\n')
+
+    def write_prometheus(self, path, prefix='stock', drop=('date',)):
+        # per-date labels would make a new series every night, they are summed away
+        counters = {}
+        timers = {}
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                key = (name, tuple(l for l in labels if l[0] not in drop))
+                counters[key] = counters.get(key, 0) + value
+            for (name, labels), (count, total, longest) in self.timers.items():
+                key = (name, tuple(l for l in labels if l[0] not in drop))
+                timer = timers.setdefault(key, [0, 0.0])
+                timer[0] += count
+                timer[1] += total
+            for (name, labels), (count, total, top) in self.samples.items():
+                key = (name, tuple(l for l in labels if l[0] not in drop))
+                stat = samples.setdefault(key, [0, 0.0, top])
+                stat[0] += count
+                stat[1] += total
+                stat[2] = max(stat[2], top)
+
+        lines = []
+        for name in sorted(set(k[0] for k in counters)):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append('%s_%s_total%s %s' % (prefix, name, format_labels(labels), value))
+        for name in sorted(set(k[0] for k in timers)):
+            lines.append('# TYPE %s_%s_seconds summary' % (prefix, name))
+            for (n, labels), (count, total) in sorted(timers.items()):
+                if n == name:
+                    lines.append('%s_%s_seconds_sum%s %f' % (prefix, name, format_labels(labels), total))
+                    lines.append('%s_%s_seconds_count%s %d' % (prefix, name, format_labels(labels), count))
+        for name in sorted(set(k[0] for k in samples)):
+            for stat in ('mean', 'max'):
+                lines.append('# TYPE %s_%s_%s gauge' % (prefix, name, stat))
+                for (n, labels), (count, total, top) in sorted(samples.items()):
+                    if n == name:
+                        value = total / count if stat == 'mean' else top
+                        lines.append('%s_%s_%s%s %f' % (prefix, name, stat, format_labels(labels), value))
+        lines.append('%s_last_run_timestamp_seconds %d' % (prefix, time.time()))
+
+        write_atomic(path, '\n'.join(lines) + '\n')
+
+def label_key(labels):
+    # label values are kept as text so keys of mixed outcomes (200, 'error') still sort
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+def write_atomic(path, text):
+    # the textfile collector may read at any moment
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+registry = Metrics()
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+def observe(name, secs, **labels):
+    registry.observe(name, secs, **labels)
+
+def sample(name, value, **labels):
+    registry.sample(name, value, **labels)
+
+def timer(name, **labels):
+    return registry.timer(name, **labels)
+
+def emit(json_path=None, prometheus_path=None, prefix='stock'):
+    if json_path:
+        registry.write_json(json_path)
+    if prometheus_path:
+        registry.write_prometheus(prometheus_path, prefix)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import sys
+import traceback
+import logging
+from psycopg2 import sql
+import db
+
+def parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Move per-stock tables into the partitioned daily_price table and the macro tables into macro_price')
+    parser.add_argument('dbname', type=str, help='DB name to operate')
+    parser.add_argument('--drop', action='store_true', help='Drop each per-stock table once its rows are moved')
+    parser.add_argument('--keys', action='store_true', help='Instead of moving rows, deduplicate every per-stock and macro table and key it on date')
+
+    return parser
+
+def migrate_macro(cursor, tbl_name, columns):
+    volume = 'volume' if 'volume' in columns else 'null'
+    db.create_macro_price(cursor)
+
+    cmd = sql.SQL('insert into macro_price ( stockno, date, volume, open, high, low, close ) select distinct on ( date ) %s, date, {}, open, high, low, close from {} where date is not null order by date, ( open > 0 and high > 0 and low > 0 and close > 0 ) desc nulls last on conflict ( stockno, date ) do nothing').format(sql.SQL(volume), db.ident(tbl_name))
+    cursor.execute(cmd, (tbl_name,))
+
+    return cursor.rowcount
+
+def migrate_table(cursor, tbl_name, columns):
+    # only TWSE tables carry traded_share, the rest are macro series
+    if 'traded_share' not in columns:
+        return migrate_macro(cursor, tbl_name, columns)
+
+    volume = 'traded_share'
+
+    if 'f_trade' in columns and 'l_trade' in columns:
+        trade = 'f_trade, l_trade'
+    else:
+        trade = 'null, null'
+
+    table = db.ident(tbl_name)
+    cmd = sql.SQL('select distinct extract(year from date)::integer from {} where date is not null').format(table)
+    cursor.execute(cmd)
+    db.ensure_partitions(cursor, [row[0] for row in cursor.fetchall()])
+
+    # old tables may carry duplicate dates, keep the row with valid prices
+    cmd = sql.SQL('insert into daily_price ( stockno, date, traded_share, open, high, low, close, f_trade, l_trade ) select distinct on ( date ) %s, date, {}, open, high, low, close, {} from {} where date is not null order by date, ( open > 0 and high > 0 and low > 0 and close > 0 ) desc nulls last on conflict ( stockno, date ) do nothing').format(sql.SQL(volume), sql.SQL(trade), table)
+    cursor.execute(cmd, (tbl_name,))
+
+    return cursor.rowcount
+
+def get_unkeyed_tables(cursor):
+    # tables with a date column and no primary key, ex. 2330, USTY, DXY
+    cmd = 'select c.table_name from information_schema.columns c where c.table_schema = current_schema() and c.column_name = \'date\' and not exists ( select 1 from information_schema.table_constraints k where k.table_schema = c.table_schema and k.table_name = c.table_name and k.constraint_type = \'PRIMARY KEY\' ) order by 1'
+    cursor.execute(cmd)
+
+    return [row[0] for row in cursor.fetchall()]
+
+def add_keys(dbname):
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        tables = get_unkeyed_tables(cursor)
+        total = 0
+        for tbl_name in tables:
+            count = db.add_date_key(cursor, tbl_name)
+            logging.info('%s: %d duplicate rows removed' % (tbl_name, count))
+            total += count
+        conn.commit()
+
+    logging.info('%d tables keyed on date, %d duplicate rows removed' % (len(tables), total))
+
+def main(argv):
+    args = parser().parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s\t%(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    if args.keys:
+        add_keys(args.dbname)
+        db.close_all()
+        return
+
+    with db.connection(args.dbname) as conn:
+        cursor = conn.cursor()
+        db.create_daily_price(cursor)
+
+        tables = db.get_price_tables(cursor)
+        total = 0
+        for tbl_name, columns in tables:
+            count = migrate_table(cursor, tbl_name, columns)
+            if args.drop:
+                cursor.execute(sql.SQL('drop table {}').format(db.ident(tbl_name)))
+            logging.info('%s: %d rows moved' % (tbl_name, count))
+            total += count
+
+        # all or nothing, a failed run leaves the old layout untouched
+        conn.commit()
+
+    logging.info('%d tables, %d rows moved into daily_price and macro_price' % (len(tables), total))
+    db.close_all()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import datetime
+import db
+
+# Tracks which (date, dataset) pairs are already in the database so reruns
+# and interrupted backfills only fetch the gaps. Datasets are 'price'
+# (MI_INDEX data5) and 'trade' (T86), other markets prefix theirs, ex.
+# 'tpex_price', see sources.py. The value is the number of rows stored, 0
+# meaning the market had no session that day. Entries are kept per storage
+# mode since both layouts can live in one database. Dates written before
+# the log existed are counted from the stored rows instead.
+
+def create_ingest_log(cursor):
+    cmd = 'create table if not exists ingest_log ( date date not null, storage text not null, dataset text not null, rows integer not null, primary key ( date, storage, dataset ) )'
+    cursor.execute(cmd)
+
+def log_datasets(cursor, storage, dataset, dates):
+    # dates maps YYYYMMDD to number of rows written, in the caller's transaction
+    create_ingest_log(cursor)
+    cmd = 'insert into ingest_log values %s on conflict ( date, storage, dataset ) do update set rows = greatest(ingest_log.rows, excluded.rows)'
+    db.execute_values(cursor, cmd, [(date, storage, dataset, int(rows)) for date, rows in sorted(dates.items())])
+
+def mark_closed(dbname, storage, date, dataset='price'):
+    # today's report may simply not be out yet
+    if date >= datetime.datetime.now().strftime('%Y%m%d'):
+        return
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        create_ingest_log(cursor)
+        cmd = 'insert into ingest_log values ( %s, %s, %s, 0 ) on conflict ( date, storage, dataset ) do nothing'
+        cursor.execute(cmd, (date, storage, dataset))
+        conn.commit()
+
+def coverage_query(cursor, storage):
+    # one statement answering per date: logged datasets plus rows actually stored
+    logged = 'select date, dataset, rows from ingest_log where storage = %(storage)s and date between %(start)s and %(end)s'
+    parts = []
+
+    if storage == 'long':
+        cursor.execute('select to_regclass(\'daily_price\') is not null')
+        if cursor.fetchone()[0]:
+            parts.append('select date, \'price\', count(*)::integer from daily_price where date between %(start)s and %(end)s group by date')
+            parts.append('select date, \'trade\', count(f_trade)::integer from daily_price where date between %(start)s and %(end)s group by date having count(f_trade) > 0')
+    else:
+        selects = []
+        for tbl_name, columns in db.get_price_tables(cursor):
+            if 'traded_share' not in columns:
+                continue
+            trade = 'f_trade' if 'f_trade' in columns else 'null::integer'
+            selects.append('select date, %s as f_trade from "%s" where date between %%(start)s and %%(end)s' % (trade, tbl_name))
+        if selects:
+            union = ' union all '.join(selects)
+            parts.append('select date, \'price\', count(*)::integer from ( %s ) p group by date' % union)
+            parts.append('select date, \'trade\', count(f_trade)::integer from ( %s ) p group by date having count(f_trade) > 0' % union)
+
+    if not parts:
+        return logged
+
+    # the stored rows can't tell the markets apart, so a logged date trusts the log
+    counted = 'select * from ( %s ) c ( date, dataset, rows ) where not exists ( select 1 from ingest_log l where l.storage = %%(storage)s and l.date = c.date )' % ' union all '.join(parts)
+
+    return '%s union all %s' % (logged, counted)
+
+class Planner(object):
+    def __init__(self, dbname, storage='table', window=60):
+        self.dbname = dbname
+        self.storage = storage
+        self.window = window
+        self.start = None
+        self.end = None
+        self.done = {}
+
+    def load(self, start, end):
+        with db.connection(self.dbname) as conn:
+            cursor = conn.cursor()
+            create_ingest_log(cursor)
+            cursor.execute(coverage_query(cursor, self.storage), {'storage': self.storage, 'start': start, 'end': end})
+            for date, dataset, rows in cursor.fetchall():
+                done = self.done.setdefault(date.strftime('%Y%m%d'), {})
+                done[dataset] = max(done.get(dataset, 0), rows)
+            conn.commit()
+
+    def status(self, date):
+        # datasets already stored for date, ex. {'price': 980, 'trade': 975}
+        dt = datetime.datetime.strptime(date, '%Y%m%d').date()
+        day = datetime.timedelta(1)
+
+        # grow the loaded range a window at a time, keeping it contiguous
+        if self.start is None:
+            self.start, self.end = dt - datetime.timedelta(self.window), dt
+            self.load(self.start, self.end)
+        elif dt < self.start:
+            start = min(dt, self.start - datetime.timedelta(self.window))
+            self.load(start, self.start - day)
+            self.start = start
+        elif dt > self.end:
+            self.load(self.end + day, dt)
+            self.end = dt
+
+        return self.done.get(date, {})
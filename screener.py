@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+import sys
+import ast
+import time
+import datetime
+import traceback
+import logging
+import warnings
+import numpy as np
+import db
+import stock
+
+# Cross-sectional screens over the whole TWSE universe. Universe keeps the
+# last days trading days of every ticker in one tickers x days x fields
+# float32 matrix; refresh() only reads again when updatedb.py logged new
+# rows, and then only from the newest day held. A screen is an expression
+# such as
+#
+#     close > max(high, 20, 1) and f_trade > 0
+#
+# where a field stands for its latest value, max/min/mean/sum/std(field, n,
+# ago=0) reduce the n days ending ago days back and ago(field, n) is the
+# value n days back. Every term is computed for all tickers at once.
+
+FIELDS = ('open', 'high', 'low', 'close', 'traded_share', 'f_trade', 'l_trade')
+ALIASES = {'volume': 'traded_share'}
+REDUCERS = {'max': np.nanmax, 'min': np.nanmin, 'mean': np.nanmean, 'sum': np.nansum, 'std': np.nanstd}
+
+def parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Screen every stock with vectorized filter expressions')
+    parser.add_argument('dbname', type=str, help='DB name to read')
+    parser.add_argument('screens', type=str, nargs='+', help='Filter expressions, ex. "close > max(high, 20, 1) and f_trade > 0"')
+    parser.add_argument('-d', '--date', type=str, help='Last date to load, format YYYYMMDD (default today)')
+    parser.add_argument('--days', type=int, default=60, help='Trading days kept per ticker')
+    parser.add_argument('--show', type=str, nargs='+', default=['close'], help='Expressions printed for every match')
+    parser.add_argument('--sort', type=str, help='Expression to order the matches by, largest first')
+    parser.add_argument('-n', '--top', type=int, help='Print only the first matches')
+    parser.add_argument('-b', '--batch', type=int, default=200, help='Tables read per query')
+
+    return parser
+
+class Universe(object):
+    def __init__(self, dbname, days=60, fields=FIELDS, batch=200):
+        self.dbname = dbname
+        self.days = days
+        self.fields = tuple(fields)
+        self.batch = batch
+        self.store = stock.Store(dbname)
+        self.stocknos = []
+        self.index = {}
+        self.dates = np.array([], dtype='datetime64[D]')
+        self.data = np.full((0, 0, len(self.fields)), np.nan, dtype=np.float32)
+        self.logged = None
+
+    def __getitem__(self, field):
+        # tickers x days
+        return self.data[:, :, self.fields.index(ALIASES.get(field, field))]
+
+    def __repr__(self):
+        return '<Universe %d tickers x %d days x %d fields>' % self.data.shape
+
+    def signature(self, cursor):
+        # changes whenever updatedb.py writes, None without an ingest_log
+        cursor.execute('select to_regclass(\'ingest_log\') is not null')
+        if not cursor.fetchone()[0]:
+            return None
+
+        cursor.execute('select count(*), sum(rows), max(date) from ingest_log')
+        return cursor.fetchone()
+
+    def refresh(self, end=None):
+        # returns whether anything was read
+        end = stock.to_date(end) if end else datetime.date.today()
+
+        with db.connection(self.dbname) as conn:
+            cursor = conn.cursor()
+            logged = (self.signature(cursor), end)
+            if len(self.dates) and logged[0] is not None and logged == self.logged:
+                conn.commit()
+                return False
+
+            # new listings get a table of their own
+            self.store.refresh()
+            tables = self.store.tables(cursor)
+            stocknos = self.store.tickers(cursor)
+            conn.commit()
+
+        if len(self.dates):
+            # the newest day again, its T86 may have come in after the prices
+            since = self.dates[-1].astype(datetime.date)
+        else:
+            # enough calendar days to hold days trading days
+            since = end - datetime.timedelta(self.days * 7 // 5 + 14)
+
+        frame = self.store.load(stocknos, since, end, self.fields, self.batch, cache=False)
+        self.merge(frame, since)
+        self.logged = logged
+
+        return True
+
+    def merge(self, frame, since):
+        # tickers keep their row, new listings go at the end
+        names = self.stocknos + [s for s in frame.stocknos if s not in self.index]
+        index = dict((s, i) for i, s in enumerate(names))
+        kept = self.dates < np.datetime64(since)
+        dates = np.concatenate([self.dates[kept], frame.dates])
+
+        data = np.full((len(names), len(dates), len(self.fields)), np.nan, dtype=np.float32)
+        data[:len(self.stocknos), :kept.sum()] = self.data[:, kept]
+        rows = [index[s] for s in frame.stocknos]
+        for k, field in enumerate(self.fields):
+            data[rows, kept.sum():, k] = frame[field]
+
+        # only the last days trading days are held
+        start = max(0, len(dates) - self.days)
+        self.stocknos = names
+        self.index = index
+        self.dates = dates[start:]
+        self.data = np.ascontiguousarray(data[:, start:])
+
+class Screen(object):
+    def __init__(self, expr):
+        self.expr = expr
+        try:
+            self.tree = ast.parse(expr.strip(), mode='eval').body
+        except SyntaxError as e:
+            raise ValueError('Invalid screen %r: %s' % (expr, e.msg))
+        self.check(self.tree)
+
+    def check(self, node):
+        # only arithmetic, comparisons, and/or/not, fields and the window functions
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in REDUCERS and node.func.id not in ('ago', 'abs'):
+                raise ValueError('Unknown function in %r: %s' % (self.expr, ast.dump(node.func)))
+            if node.keywords:
+                raise ValueError('Keyword arguments aren\'t supported in %r' % self.expr)
+            if node.func.id == 'abs':
+                if len(node.args) != 1:
+                    raise ValueError('abs() takes one argument in %r' % self.expr)
+                self.check(node.args[0])
+                return
+            if not 2 <= len(node.args) <= (2 if node.func.id == 'ago' else 3) or not isinstance(node.args[0], ast.Name) or \
+                    not all(isinstance(a, ast.Constant) and type(a.value) is int and a.value >= 0 for a in node.args[1:]):
+                raise ValueError('%s() takes a field and day counts in %r' % (node.func.id, self.expr))
+            self.check(node.args[0])
+        elif isinstance(node, ast.Name):
+            if ALIASES.get(node.id, node.id) not in FIELDS:
+                raise ValueError('Unknown field in %r: %s' % (self.expr, node.id))
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+                raise ValueError('Only numbers are allowed in %r' % self.expr)
+        elif isinstance(node, ast.Compare) and not all(type(op) in COMPARE for op in node.ops):
+            raise ValueError('Unsupported comparison in %r' % self.expr)
+        elif isinstance(node, ast.BoolOp) or isinstance(node, ast.Compare):
+            for child in (node.values if isinstance(node, ast.BoolOp) else [node.left] + node.comparators):
+                self.check(child)
+        elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.Div)):
+            self.check(node.left)
+            self.check(node.right)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.USub, ast.UAdd)):
+            self.check(node.operand)
+        else:
+            raise ValueError('Unsupported expression in %r: %s' % (self.expr, type(node).__name__))
+
+    def __call__(self, universe, cache=None):
+        # one value per ticker, a boolean mask for a filter
+        with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return evaluate(self.tree, universe, {} if cache is None else cache)
+
+def window(universe, field, n, ago):
+    values = universe[field]
+    end = values.shape[1] - ago
+    if n < 1 or end - n < 0:
+        return None
+
+    return values[:, end - n:end]
+
+def evaluate(node, universe, cache):
+    key = ast.dump(node)
+    if key in cache:
+        return cache[key]
+
+    if isinstance(node, ast.Name):
+        values = universe[node.id]
+        result = values[:, -1].astype(np.float64) if values.shape[1] else np.full(values.shape[0], np.nan)
+    elif isinstance(node, ast.Constant):
+        result = node.value
+    elif isinstance(node, ast.Call):
+        name = node.func.id
+        if name == 'abs':
+            result = np.abs(evaluate(node.args[0], universe, cache))
+        else:
+            counts = [a.value for a in node.args[1:]]
+            if name == 'ago':
+                values = window(universe, node.args[0].id, 1, counts[0])
+            else:
+                values = window(universe, node.args[0].id, counts[0], counts[1] if len(counts) > 1 else 0)
+            if values is None:
+                # not enough days held, nothing passes
+                result = np.full(len(universe.stocknos), np.nan)
+            elif name == 'ago':
+                result = values[:, 0].astype(np.float64)
+            else:
+                result = REDUCERS[name](values, axis=1).astype(np.float64)
+    elif isinstance(node, ast.BinOp):
+        left = evaluate(node.left, universe, cache)
+        right = evaluate(node.right, universe, cache)
+        if isinstance(node.op, ast.Add):
+            result = left + right
+        elif isinstance(node.op, ast.Sub):
+            result = left - right
+        elif isinstance(node.op, ast.Mult):
+            result = left * right
+        else:
+            result = np.true_divide(left, right)
+    elif isinstance(node, ast.UnaryOp):
+        operand = evaluate(node.operand, universe, cache)
+        if isinstance(node.op, ast.Not):
+            result = ~truth(operand)
+        elif isinstance(node.op, ast.USub):
+            result = -operand
+        else:
+            result = operand
+    elif isinstance(node, ast.Compare):
+        result = True
+        left = evaluate(node.left, universe, cache)
+        for op, comparator in zip(node.ops, node.comparators):
+            right = evaluate(comparator, universe, cache)
+            result = result & COMPARE[type(op)](left, right)
+            left = right
+    else:
+        result = truth(evaluate(node.values[0], universe, cache))
+        for value in node.values[1:]:
+            if isinstance(node.op, ast.And):
+                result = result & truth(evaluate(value, universe, cache))
+            else:
+                result = result | truth(evaluate(value, universe, cache))
+
+    cache[key] = result
+    return result
+
+COMPARE = {ast.Gt: np.greater, ast.GtE: np.greater_equal, ast.Lt: np.less, ast.LtE: np.less_equal,
+           ast.Eq: np.equal, ast.NotEq: np.not_equal}
+
+def truth(values):
+    # NaN, a missing day, never passes
+    values = np.asarray(values)
+    if values.dtype == bool:
+        return values
+
+    return ~np.isnan(values) & (values != 0)
+
+def screen(universe, expr, show=(), sort=None, top=None):
+    # matching stocknos and the show values of each, sorted by sort descending
+    cache = {}
+    mask = truth(Screen(expr)(universe, cache))
+    if mask.ndim == 0:
+        mask = np.full(len(universe.stocknos), bool(mask))
+    matches = np.flatnonzero(mask)
+
+    if sort:
+        order = Screen(sort)(universe, cache)[matches]
+        matches = matches[np.argsort(-np.nan_to_num(order, nan=-np.inf), kind='stable')]
+    if top:
+        matches = matches[:top]
+
+    columns = []
+    for expr in show:
+        values = np.broadcast_to(Screen(expr)(universe, cache), (len(universe.stocknos),))
+        columns.append(values[matches])
+
+    return [universe.stocknos[i] for i in matches], columns
+
+def print_matches(stocknos, show, columns):
+    print('\t'.join(['stockno'] + list(show)))
+    for i, stockno in enumerate(stocknos):
+        print('\t'.join([stockno] + ['%.2f' % c[i] for c in columns]))
+
+def main(argv):
+    args = parser().parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s\t%(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    if args.date:
+        try:
+            datetime.datetime.strptime(args.date, '%Y%m%d')
+        except ValueError as e:
+            logging.error('Invalid Date: %s' % args.date)
+            sys.exit(1)
+
+    try:
+        for expr in args.screens + args.show + ([args.sort] if args.sort else []):
+            Screen(expr)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+
+    start = time.time()
+    universe = Universe(args.dbname, args.days, batch=args.batch)
+    universe.refresh(args.date)
+    logging.info('%r loaded in %.3fs' % (universe, time.time() - start))
+
+    for expr in args.screens:
+        start = time.time()
+        stocknos, columns = screen(universe, expr, args.show, args.sort, args.top)
+        logging.info('%s: %d matches in %.1fms' % (expr, len(stocknos), (time.time() - start) * 1000))
+        print_matches(stocknos, args.show, columns)
+
+    db.close_all()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit(1)
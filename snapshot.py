@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import shutil
+import datetime
+import traceback
+import logging
+from collections import OrderedDict
+import numpy as np
+import db
+import stock
+
+# Columnar snapshot of the price database for backtests. Every month is a
+# directory YYYYMM holding dates.npy, stocknos.npy and one tickers x dates
+# float64 <field>.npy per field, so readers mmap only the months they need.
+# Months before the last exported one are never rewritten, a rerun only
+# re-exports the last month and anything newer.
+
+EXPORT_FIELDS = ('open', 'high', 'low', 'close', 'traded_share', 'f_trade', 'l_trade')
+MANIFEST = 'manifest.json'
+
+def parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export the price database into memory-mapped NumPy column files')
+    parser.add_argument('dbname', type=str, help='DB name to export')
+    parser.add_argument('-o', '--output', type=str, default='snapshot', help='Snapshot directory')
+    parser.add_argument('--fields', type=str, nargs='+', default=list(EXPORT_FIELDS), help='Columns to export, ex. close y10')
+    parser.add_argument('--full', action='store_true', help='Rewrite every month instead of appending new days')
+    parser.add_argument('-b', '--batch', type=int, default=200, help='Tables read per query')
+
+    return parser
+
+def read_manifest(root):
+    path = os.path.join(root, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+def write_manifest(root, manifest):
+    tmp = os.path.join(root, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(root, MANIFEST))
+
+def read_months(dbname, fields, start, end, batch):
+    # month -> stockno -> [ ( date, values... ) ], one query per batch of tables
+    store = stock.Store(dbname)
+    months = {}
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        stocknos = store.stocknos(cursor)
+
+        for i in range(0, len(stocknos), batch):
+            cmd, params = store.query(cursor, stocknos[i:i + batch], fields)
+            if not cmd:
+                continue
+            params['start'] = start
+            params['end'] = end
+            cursor.execute(cmd, params)
+            for row in cursor.fetchall():
+                month = months.setdefault(row[1].strftime('%Y%m'), {})
+                month.setdefault(row[0], []).append(row[1:])
+        conn.commit()
+
+    return months
+
+def write_partition(root, month, fields, rows):
+    stocknos = sorted(rows)
+    dates = np.unique(np.array([r[0] for s in stocknos for r in rows[s]], dtype='datetime64[D]'))
+
+    columns = dict((f, np.full((len(stocknos), len(dates)), np.nan)) for f in fields)
+    for i, stockno in enumerate(stocknos):
+        data = rows[stockno]
+        pos = np.searchsorted(dates, np.array([r[0] for r in data], dtype='datetime64[D]'))
+        for j, field in enumerate(fields):
+            columns[field][i, pos] = [np.nan if r[j + 1] is None else r[j + 1] for r in data]
+
+    # build next to the old partition and swap it in, readers never see half a month
+    path = os.path.join(root, month)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    np.save(os.path.join(tmp, 'dates.npy'), dates)
+    np.save(os.path.join(tmp, 'stocknos.npy'), np.array(stocknos, dtype=str))
+    for field in fields:
+        np.save(os.path.join(tmp, '%s.npy' % field), columns[field])
+
+    if os.path.exists(path):
+        old = path + '.old'
+        os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old)
+    else:
+        os.rename(tmp, path)
+
+    return len(stocknos), len(dates)
+
+def export(dbname, root, fields=EXPORT_FIELDS, full=False, batch=200):
+    fields = list(fields)
+    manifest = read_manifest(root)
+
+    if manifest and manifest['fields'] != fields and not full:
+        logging.error('Snapshot %s holds fields %s, rerun with --full to change them' % (root, ', '.join(manifest['fields'])))
+        return None
+
+    start = datetime.date(1900, 1, 1)
+    if manifest.get('partitions') and not full:
+        # the last month may have been exported half way through
+        start = datetime.datetime.strptime(manifest['partitions'][-1], '%Y%m').date()
+    else:
+        manifest = {'partitions': []}
+    end = datetime.date.today()
+
+    if not os.path.exists(root):
+        os.makedirs(root)
+
+    months = read_months(dbname, fields, start, end, batch)
+    for month in sorted(months):
+        tickers, days = write_partition(root, month, fields, months[month])
+        logging.info('%s: %d tickers, %d days' % (month, tickers, days))
+
+    manifest['fields'] = fields
+    manifest['partitions'] = sorted(set(manifest['partitions']) | set(months))
+    write_manifest(root, manifest)
+
+    return sorted(months)
+
+def load(root, start=None, end=None, fields=None, stocknos=None):
+    # mmap the months overlapping start..end into a stock.Frame
+    manifest = read_manifest(root)
+    fields = list(fields or manifest.get('fields', []))
+    start = np.datetime64(stock.to_date(start)) if start else None
+    end = np.datetime64(stock.to_date(end)) if end else None
+
+    parts = []
+    for month in manifest.get('partitions', []):
+        first = np.datetime64('%s-%s-01' % (month[:4], month[4:]), 'D')
+        if end is not None and first > end:
+            continue
+        if start is not None and first + np.timedelta64(31, 'D') < start:
+            continue
+
+        path = os.path.join(root, month)
+        dates = np.load(os.path.join(path, 'dates.npy'), mmap_mode='r')
+        keep = np.ones(len(dates), dtype=bool)
+        if start is not None:
+            keep &= dates >= start
+        if end is not None:
+            keep &= dates <= end
+        if keep.any():
+            names = np.load(os.path.join(path, 'stocknos.npy'), mmap_mode='r')
+            parts.append((path, np.asarray(dates[keep]), keep, [str(s) for s in names]))
+
+    if stocknos is None:
+        stocknos = sorted(set(s for p in parts for s in p[3]))
+    elif isinstance(stocknos, str):
+        stocknos = [stocknos]
+
+    if parts:
+        dates = np.concatenate([p[1] for p in parts])
+    else:
+        dates = np.array([], dtype='datetime64[D]')
+
+    columns = OrderedDict((f, np.full((len(stocknos), len(dates)), np.nan)) for f in fields)
+    offset = 0
+    for path, part_dates, keep, names in parts:
+        index = dict((s, i) for i, s in enumerate(names))
+        dst = [i for i, s in enumerate(stocknos) if s in index]
+        src = [index[stocknos[i]] for i in dst]
+        span = slice(offset, offset + len(part_dates))
+        for field in fields:
+            values = np.load(os.path.join(path, '%s.npy' % field), mmap_mode='r')
+            columns[field][dst, span] = values[src][:, keep]
+        offset += len(part_dates)
+
+    return stock.Frame(stocknos, dates, columns)
+
+def main(argv):
+    args = parser().parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s\t%(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    months = export(args.dbname, args.output, args.fields, args.full, args.batch)
+    if months is None:
+        sys.exit(1)
+
+    logging.info('%d months written to %s' % (len(months), args.output))
+    db.close_all()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv)
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit(1)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import time
+from collections import OrderedDict
+
+# Markets updatedb.py ingests. Every market has two daily reports, prices
+# and institutional trades; a Report says where it is, how a date is asked
+# for, which top-level key holds the rows and which column of a row holds
+# each field. A market with rows that don't fit a column map can give a
+# report its own parse(rows) returning the rows in the mapped layout.
+# Planner datasets are named after the market so every market is tracked
+# on its own, TWSE keeps the plain 'price' and 'trade' of older databases.
+# A reply answers a report when it holds the rows (with an 'OK' status
+# where the report has one) or when its status is the report's own notice
+# of a day without a session. Anything else, an empty, throttled or
+# reshaped reply, is neither cached nor taken for a closed market.
+
+PRICE_COLUMNS = ('stockno', 'traded_share', 'open', 'high', 'low', 'close')
+TRADE_COLUMNS = ('stockno', 'f_trade', 'l_trade')
+
+# TWSE's stat on a day without a session
+TWSE_NO_DATA = '很抱歉，沒有符合條件的資料!'
+
+def cache_buster(date):
+    return str(round(time.time() * 1000) - 500)
+
+def roc_date(date):
+    # TPEx counts years from 1912, ex. 20170621 -> 106/06/21
+    return '%d/%s/%s' % (int(date[:4]) - 1911, date[4:6], date[6:])
+
+class Report(object):
+    def __init__(self, path, params, key, columns, parse=None, status=None, ok=(), no_data=()):
+        self.path = path
+        self.params = params
+        self.key = key
+        self.columns = columns
+        self.parse = parse
+        self.status = status
+        self.ok = ok
+        self.no_data = no_data
+
+    def query(self, date):
+        # param values may be functions of the YYYYMMDD date
+        return dict((k, v(date) if callable(v) else v) for k, v in self.params.items())
+
+    def width(self):
+        return max(self.columns.values()) + 1
+
+    def members(self):
+        # top-level keys worth decoding from a reply
+        return (self.key, self.status) if self.status else (self.key,)
+
+    def closed(self, content):
+        # the report's own word that the market had no session
+        return bool(self.status) and content.get(self.status) in self.no_data
+
+    def answered(self, content):
+        if self.key in content:
+            return not self.status or content.get(self.status) in self.ok
+
+        return self.closed(content)
+
+class Source(object):
+    def __init__(self, name, url, price, trade, prefix=''):
+        self.name = name
+        self.url = url
+        self.price = price
+        self.trade = trade
+        self.prefix = prefix
+
+    def dataset(self, kind):
+        return self.prefix + kind
+
+    def endpoint(self, report):
+        return self.url + report.path
+
+    def at(self, url):
+        # the same market served from another host, ex. the fixture server
+        return Source(self.name, url.rstrip('/'), self.price, self.trade, self.prefix)
+
+    def __repr__(self):
+        return '<Source %s %s>' % (self.name, self.url)
+
+registry = OrderedDict()
+
+def register(source):
+    registry[source.name] = source
+    return source
+
+def select(names=None, url=None):
+    # registered markets in registry order, all of them by default
+    names = list(registry) if names is None else names
+    missing = [n for n in names if n not in registry]
+    if missing:
+        raise KeyError('Unknown market %s' % ', '.join(missing))
+
+    return [registry[n].at(url) if url else registry[n] for n in registry if n in names]
+
+register(Source('twse', 'http://www.twse.com.tw',
+    price=Report('/exchangeReport/MI_INDEX',
+                 {'date': lambda date: date, 'response': 'json', 'type': 'ALL', '_': cache_buster}, 'data5',
+                 {'stockno': 0, 'traded_share': 2, 'open': 5, 'high': 6, 'low': 7, 'close': 8},
+                 status='stat', ok=('OK',), no_data=(TWSE_NO_DATA,)),
+    trade=Report('/fund/T86',
+                 {'date': lambda date: date, 'response': 'json', 'selectType': 'ALL', '_': cache_buster}, 'data',
+                 {'stockno': 0, 'f_trade': 4, 'l_trade': 7},
+                 status='stat', ok=('OK',), no_data=(TWSE_NO_DATA,))))
+
+register(Source('tpex', 'http://www.tpex.org.tw',
+    price=Report('/web/stock/aftertrading/daily_close_quotes/stk_quote_result.php',
+                 {'l': 'zh-tw', 'o': 'json', 'd': roc_date}, 'aaData',
+                 {'stockno': 0, 'close': 2, 'open': 4, 'high': 5, 'low': 6, 'traded_share': 8}),
+    trade=Report('/web/stock/3insti/daily_trade/3itrade_hedge_result.php',
+                 {'l': 'zh-tw', 'o': 'json', 'se': 'EW', 't': 'D', 'd': roc_date}, 'aaData',
+                 {'stockno': 0, 'f_trade': 4, 'l_trade': 7}),
+    prefix='tpex_'))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+import datetime
+import threading
+from collections import OrderedDict
+import numpy as np
+import db
+
+# Read side of the price database. load() returns a Frame holding one
+# tickers x dates matrix per field, fetched with one query per batch of
+# tickers and kept in an LRU cache so repeated studies come from memory.
+# Works with the per-stock tables, the macro tables (USTY, DXY, ...) and
+# the long-format daily_price and macro_price tables. Only exchange tickers
+# are listed by stocknos(), macro series are loaded by name.
+
+DEFAULT_FIELDS = ('open', 'high', 'low', 'close')
+
+def to_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+
+    return datetime.datetime.strptime(str(value), '%Y%m%d').date()
+
+class Frame(object):
+    def __init__(self, stocknos, dates, columns):
+        self.stocknos = list(stocknos)
+        self.dates = dates
+        self.columns = columns
+        self.index = dict((s, i) for i, s in enumerate(self.stocknos))
+
+    def __getitem__(self, field):
+        # tickers x dates, NaN where there is no row
+        return self.columns[field]
+
+    def series(self, stockno, field):
+        return self.columns[field][self.index[stockno]]
+
+    @property
+    def fields(self):
+        return list(self.columns)
+
+    def __repr__(self):
+        return '<Frame %d tickers x %d dates, fields %s>' % (len(self.stocknos), len(self.dates), ', '.join(self.columns))
+
+class LRUCache(object):
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key).nbytes
+            self.items[key] = value
+            self.size += value.nbytes
+            while self.size > self.budget and len(self.items) > 1:
+                old_key, old = self.items.popitem(last=False)
+                self.size -= old.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+class Store(object):
+    def __init__(self, dbname, budget=256 << 20):
+        self.dbname = dbname
+        self.cache = LRUCache(budget)
+        self.catalog = None
+
+    def tables(self, cursor):
+        # table name -> column names, read once per store
+        if self.catalog is None:
+            cmd = 'select table_name, array_agg(column_name::text) from information_schema.columns where table_schema = current_schema() group by table_name'
+            cursor.execute(cmd)
+            self.catalog = dict((row[0], set(row[1])) for row in cursor.fetchall())
+
+        return self.catalog
+
+    def refresh(self):
+        # forget cached rows and the catalog, ex. after updatedb.py ran
+        self.catalog = None
+        self.cache.clear()
+
+    def query(self, cursor, stocknos, fields):
+        tables = self.tables(cursor)
+        parts = []
+        params = {'start': None, 'end': None}
+
+        long_format = []
+        for stockno in stocknos:
+            columns = tables.get(stockno)
+            if columns is None:
+                long_format.append(stockno)
+                continue
+            select = ', '.join(self.column(f, columns) for f in fields)
+            parts.append('select %%(s%d)s::text, date, %s from "%s" where date between %%(start)s and %%(end)s' % (len(params), select, stockno))
+            params['s%d' % len(params)] = stockno
+
+        for long_table in ('daily_price', 'macro_price'):
+            if long_format and long_table in tables:
+                select = ', '.join(self.column(f, tables[long_table]) for f in fields)
+                parts.append('select stockno, date, %s from %s where stockno = any(%%(long)s) and date between %%(start)s and %%(end)s' % (select, long_table))
+                params['long'] = long_format
+
+        return ' union all '.join(parts), params
+
+    def column(self, field, columns):
+        # volume is called traded_share in the TWSE tables
+        if field in columns:
+            return '"%s"::float8' % field
+        if field == 'volume' and 'traded_share' in columns:
+            return 'traded_share::float8'
+        if field == 'traded_share' and 'volume' in columns:
+            return 'volume::float8'
+
+        return 'null::float8'
+
+    def stocknos(self, cursor):
+        # every table keyed by date, plus the series stored in long format
+        tables = self.tables(cursor)
+        skip = set(['daily_price', 'macro_price', 'ingest_log', 'indicators', 'indicator_state', 'fx_rates',
+                    'corporate_actions', 'adjusted_price', 'adjust_state'])
+        stocknos = set(t for t, columns in tables.items() if 'date' in columns and t not in skip and not t.startswith('daily_price_'))
+
+        for long_table in ('daily_price', 'macro_price'):
+            if long_table in tables:
+                cursor.execute('select distinct stockno from %s' % long_table)
+                stocknos.update(row[0] for row in cursor.fetchall())
+
+        return sorted(stocknos)
+
+    def tickers(self, cursor):
+        # exchange tickers only, the per-stock tables carry traded_share and
+        # the macro series don't
+        tables = self.tables(cursor)
+        stocknos = set(t for t, columns in tables.items() if 'traded_share' in columns and 'date' in columns
+                       and t not in ('daily_price', 'adjusted_price') and not t.startswith('daily_price_'))
+
+        if 'daily_price' in tables:
+            cursor.execute('select distinct stockno from daily_price')
+            stocknos.update(row[0] for row in cursor.fetchall())
+
+        return sorted(stocknos)
+
+    def read(self, stocknos, start, end, fields):
+        # one round trip for the whole batch, stockno -> ( dates, [ values per field ] )
+        rows = {}
+        with db.connection(self.dbname) as conn:
+            cursor = conn.cursor()
+            cmd, params = self.query(cursor, stocknos, fields)
+            if cmd:
+                params['start'] = start
+                params['end'] = end
+                cursor.execute(cmd + ' order by 1, 2', params)
+                for row in cursor.fetchall():
+                    rows.setdefault(row[0], []).append(row[1:])
+            conn.commit()
+
+        result = {}
+        for stockno in stocknos:
+            data = rows.get(stockno, [])
+            dates = np.array([r[0] for r in data], dtype='datetime64[D]')
+            values = [np.array([np.nan if r[i + 1] is None else r[i + 1] for r in data], dtype=np.float64) for i in range(len(fields))]
+            result[stockno] = (dates, values)
+
+        return result
+
+    def fetch(self, stocknos, start, end, fields):
+        for stockno, (dates, values) in self.read(stocknos, start, end, fields).items():
+            self.cache.put((stockno, 'date', start, end), dates)
+            for field, value in zip(fields, values):
+                self.cache.put((stockno, field, start, end), value)
+
+    def cached(self, stockno, fields, start, end):
+        dates = self.cache.get((stockno, 'date', start, end))
+        if dates is None:
+            return None
+
+        values = []
+        for field in fields:
+            value = self.cache.get((stockno, field, start, end))
+            if value is None:
+                return None
+            values.append(value)
+
+        return dates, values
+
+    def load(self, stocknos, start, end, fields=DEFAULT_FIELDS, batch=200, cache=True):
+        if isinstance(stocknos, str):
+            stocknos = [stocknos]
+        stocknos = list(stocknos)
+        fields = tuple(fields)
+        start = to_date(start)
+        end = to_date(end)
+
+        if not cache:
+            # bulk reads, ex. a backfill, would only flush the cache
+            per_stock = {}
+            for i in range(0, len(stocknos), batch):
+                per_stock.update(self.read(stocknos[i:i + batch], start, end, fields))
+            return align(stocknos, fields, [per_stock[s] for s in stocknos])
+
+        missing = [s for s in stocknos if self.cached(s, fields, start, end) is None]
+        for i in range(0, len(missing), batch):
+            self.fetch(missing[i:i + batch], start, end, fields)
+
+        per_stock = []
+        for stockno in stocknos:
+            hit = self.cached(stockno, fields, start, end)
+            if hit is None:
+                # evicted while loading the rest, the budget is too small for this request
+                hit = self.read([stockno], start, end, fields)[stockno]
+            per_stock.append(hit)
+
+        return align(stocknos, fields, per_stock)
+
+def align(stocknos, fields, per_stock):
+    # put every ticker on the union of their dates
+    if per_stock:
+        dates = np.unique(np.concatenate([p[0] for p in per_stock]))
+    else:
+        dates = np.array([], dtype='datetime64[D]')
+
+    columns = OrderedDict((f, np.full((len(stocknos), len(dates)), np.nan)) for f in fields)
+    for i, (stock_dates, values) in enumerate(per_stock):
+        pos = np.searchsorted(dates, stock_dates)
+        for field, value in zip(fields, values):
+            columns[field][i, pos] = value
+
+    return Frame(stocknos, dates, columns)
+
+_stores = {}
+
+def get_store(dbname='stock', budget=256 << 20):
+    if dbname not in _stores:
+        _stores[dbname] = Store(dbname, budget)
+
+    return _stores[dbname]
+
+def load(stocknos, start, end, fields=DEFAULT_FIELDS, dbname='stock'):
+    # ex. load(['2330', '2317'], '20170101', '20170621', ['close', 'f_trade'])
+    return get_store(dbname).load(stocknos, start, end, fields)
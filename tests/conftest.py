@@ -0,0 +1,31 @@
+import os
+import sys
+import getpass
+import pytest
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+def admin_execute(cmd):
+    conn = psycopg2.connect(database='postgres', user=getpass.getuser())
+    conn.autocommit = True
+    conn.cursor().execute(cmd)
+    conn.close()
+
+@pytest.fixture
+def dbname():
+    # a throwaway database per test, skipped where no server is reachable
+    name = 'stock_test_%d' % os.getpid()
+    try:
+        admin_execute('drop database if exists "%s"' % name)
+        admin_execute('create database "%s"' % name)
+    except psycopg2.OperationalError as e:
+        pytest.skip('No PostgreSQL server: %s' % e)
+
+    try:
+        yield name
+    finally:
+        db.close_all()
+        admin_execute('drop database "%s"' % name)
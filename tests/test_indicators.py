@@ -0,0 +1,48 @@
+import db
+import indicators
+import sources
+import updatedb
+
+DATES = ['20170619', '20170620', '20170621']
+
+def write_day(dbname, date, close, net=None):
+    twse = sources.select(['twse'])[0]
+    rows = [['2330', 'TSMC', '1,000', '1', '216,000', close, close, close, close]]
+    updatedb.write_price_info(dbname, updatedb.parse_price_info(twse, date, rows))
+    if net is not None:
+        info = [['2330', 'TSMC', '0', '0', net, '0', '0', net, '0']]
+        updatedb.write_trade_info(dbname, date, updatedb.parse_trade_info(twse, date, info))
+
+def read(dbname):
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        cursor.execute('select to_char(date, \'YYYYMMDD\'), f_streak, l_streak from indicators order by date')
+        rows = cursor.fetchall()
+        cursor.execute('select to_char(date, \'YYYYMMDD\'), f_streak from indicator_state')
+        state = cursor.fetchall()
+        conn.commit()
+
+    return rows, state
+
+def test_late_t86_fills_the_streak(dbname):
+    write_day(dbname, DATES[0], '215.00', '100')
+    write_day(dbname, DATES[1], '216.00', '200')
+    write_day(dbname, DATES[2], '217.00')
+    indicators.update(dbname, DATES[-1])
+
+    rows, state = read(dbname)
+    assert rows[-1] == (DATES[2], None, None)
+    assert state == [(DATES[1], 2)]
+
+    # T86 comes out after the evening run
+    twse = sources.select(['twse'])[0]
+    info = [['2330', 'TSMC', '0', '0', '300', '0', '0', '-5', '0']]
+    updatedb.write_trade_info(dbname, DATES[2], updatedb.parse_trade_info(twse, DATES[2], info))
+    indicators.update(dbname, DATES[-1])
+
+    rows, state = read(dbname)
+    assert rows == [(DATES[0], 1, 1), (DATES[1], 2, 2), (DATES[2], 3, -1)]
+    assert state == [(DATES[2], 3)]
+
+    indicators.update(dbname, DATES[-1], backfill=True)
+    assert read(dbname) == (rows, state)
@@ -0,0 +1,38 @@
+import socket
+import fetch
+import metrics
+import fixtureserver
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+def test_mixed_outcomes_are_emitted(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, 'registry', metrics.Metrics())
+    srv, url = fixtureserver.start_server(stocks=10)
+    try:
+        fetcher = fetch.PageFetcher(timeout=5)
+        assert fetcher.get_members(url + '/exchangeReport/MI_INDEX', {'date': '20170621'}, ['stat'])
+        assert fetcher.get_members(url + '/nowhere', {}, ['stat']) is None
+        assert fetcher.get_members('http://127.0.0.1:%d/' % free_port(), {}, ['stat']) is None
+        assert fetcher.get(url + '/nowhere') is None
+    finally:
+        srv.shutdown()
+
+    summary = metrics.registry.summary()
+    statuses = sorted(c['labels']['status'] for c in summary['counters'] if c['name'] == 'http_requests')
+    assert statuses == ['200', '404', 'error']
+
+    # a counter labelled by an int still sorts next to text labels
+    metrics.inc('sources', source='twse', status=0)
+    metrics.inc('sources', source='twse', status='timeout')
+    metrics.emit(str(tmp_path / 'run.json'), str(tmp_path / 'run.prom'), 'stock_test')
+
+    prom = (tmp_path / 'run.prom').read_text()
+    assert 'stock_test_http_requests_total{source="127.0.0.1:%d",status="200"} 1' % srv.server_address[1] in prom
+    assert 'status="error"' in prom
+    assert 'stock_test_sources_total{source="twse",status="0"} 1' in prom
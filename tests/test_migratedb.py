@@ -0,0 +1,19 @@
+import db
+import migratedb
+
+def test_migrate_keeps_valid_duplicate(dbname):
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        cursor.execute('create table "2330" ( date date, traded_share bigint, open real, high real, low real, close real )')
+        cursor.execute('insert into "2330" values ( \'2017-06-21\', 100, null, null, null, null ), ( \'2017-06-21\', 100, 215, 217, 214, 216 ), ( \'2017-06-20\', 90, 0, 0, 0, 0 ), ( \'2017-06-20\', 90, 210, 212, 209, 211 )')
+        conn.commit()
+
+    migratedb.main(['migratedb.py', dbname])
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        cursor.execute('select date::text, close from daily_price where stockno = \'2330\' order by date')
+        rows = cursor.fetchall()
+        conn.commit()
+
+    assert rows == [('2017-06-20', 211.0), ('2017-06-21', 216.0)]
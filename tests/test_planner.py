@@ -0,0 +1,47 @@
+import db
+import planner
+import sources
+import stock
+import updatedb
+import updatetbl
+
+ROWS = [
+    ['2330', 'TSMC', '1,000', '1', '216,000', '215.00', '217.00', '214.00', '216.00'],
+    ['2317', 'Hon Hai', '2,000', '1', '170,000', '85.00', '86.00', '84.00', '85.50'],
+]
+
+def test_long_macros_are_not_trading_days(dbname):
+    twse = sources.select(['twse'])[0]
+    updatedb.write_price_info(dbname, updatedb.parse_price_info(twse, '20170621', ROWS, 'long'), 'long')
+
+    # an older updatetbl run left DXY in daily_price
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        db.copy_daily_price(cursor, [('DXY', '20170617', None, 97.0, 97.5, 96.5, 97.2)])
+        conn.commit()
+
+    records = [('20170616', (97.1, 97.6, 96.6, 97.3)), ('20170619', (97.2, 97.7, 96.7, 97.4))]
+    updatetbl.write_table(dbname, 'DXY', ('open', 'high', 'low', 'close'), records, 'long')
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        cursor.execute('select stockno, count(*) from daily_price group by 1 order by 1')
+        assert cursor.fetchall() == [('2317', 1), ('2330', 1)]
+        cursor.execute('select to_char(date, \'YYYYMMDD\') from macro_price where stockno = \'DXY\' order by 1')
+        assert [row[0] for row in cursor.fetchall()] == ['20170616', '20170617', '20170619']
+        conn.commit()
+
+    plan = planner.Planner(dbname, 'long')
+    assert plan.status('20170621') == {'price': 2}
+    for date in ('20170616', '20170617', '20170619'):
+        assert plan.status(date) == {}
+
+    store = stock.Store(dbname)
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        assert store.tickers(cursor) == ['2317', '2330']
+        assert 'DXY' in store.stocknos(cursor)
+        conn.commit()
+
+    frame = store.load('DXY', '20170616', '20170621', ['close'])
+    assert [round(float(v), 1) for v in frame.series('DXY', 'close')] == [97.3, 97.2, 97.4]
@@ -0,0 +1,14 @@
+import pytest
+import screener
+
+def test_valid_screens():
+    for expr in ('close > max(high, 20, 1) and f_trade > 0', '1 < close <= 2', 'close != ago(close, 1)', 'abs(close - open) == 0'):
+        screener.Screen(expr)
+
+@pytest.mark.parametrize('expr', [
+    'close is 1', 'close is not 1', 'close in 1', 'close not in 1', '1 < close in 2',
+    'max(close, True)', 'mean(close, 5, False)', 'ago(close, True)', 'max(close, 2.0)',
+])
+def test_bad_screens_fail_at_check(expr):
+    with pytest.raises(ValueError):
+        screener.Screen(expr)
@@ -0,0 +1,165 @@
+import pytest
+import datetime
+import threading
+import numpy as np
+import db
+import cache
+import fetch
+import sources
+import updatedb
+
+class Replies(object):
+    # stands in for fetch.PageFetcher, answering every request with reply
+    def __init__(self, reply):
+        self.reply = reply
+        self.calls = 0
+
+    def get_members(self, url, params, keys):
+        self.calls += 1
+        return self.reply
+
+def fetch_price(monkeypatch, tmp_path, reply):
+    fetcher = Replies(reply)
+    monkeypatch.setattr(updatedb, 'fetcher', fetcher)
+    monkeypatch.setattr(updatedb, 'response_cache', cache.ResponseCache(str(tmp_path)))
+    twse = sources.select(['twse'])[0]
+
+    return updatedb.get_price_info(twse, '20170620'), fetcher
+
+def test_throttled_reply_is_not_cached(monkeypatch, tmp_path):
+    data, fetcher = fetch_price(monkeypatch, tmp_path, {})
+    assert data is None
+    assert updatedb.response_cache.size == 0
+
+    data, fetcher = fetch_price(monkeypatch, tmp_path, {'stat': '查詢過於頻繁'})
+    assert data is None
+    assert updatedb.response_cache.size == 0
+
+def test_ok_reply_without_rows_is_a_failed_fetch(monkeypatch, tmp_path):
+    data, fetcher = fetch_price(monkeypatch, tmp_path, {'stat': 'OK'})
+    assert data is None
+    assert updatedb.response_cache.size == 0
+
+    data, fetcher = fetch_price(monkeypatch, tmp_path, {'stat': '查詢過於頻繁', 'data5': []})
+    assert data is None
+    assert updatedb.response_cache.size == 0
+
+def test_closed_and_open_days_are_cached(monkeypatch, tmp_path):
+    data, fetcher = fetch_price(monkeypatch, tmp_path, {'stat': sources.TWSE_NO_DATA})
+    assert data == []
+    assert updatedb.response_cache.size > 0
+
+    row = ['2330', 'TSMC', '1,000', '1', '216,000', '215.00', '217.00', '214.00', '216.00']
+    data, fetcher = fetch_price(monkeypatch, tmp_path / 'open', {'stat': 'OK', 'data5': [row]})
+    assert data == [row]
+    twse = sources.select(['twse'])[0]
+    assert updatedb.get_price_info(twse, '20170620') == [row]
+    assert fetcher.calls == 1
+
+def test_cached_empty_reply_is_fetched_again(monkeypatch, tmp_path):
+    twse = sources.select(['twse'])[0]
+    response_cache = cache.ResponseCache(str(tmp_path))
+    response_cache.put(twse.endpoint(twse.price), twse.price.query('20170620'), {})
+
+    data, fetcher = fetch_price(monkeypatch, tmp_path, {'stat': sources.TWSE_NO_DATA})
+    assert data == []
+    assert fetcher.calls == 1
+
+def test_to_numeric_masks_non_finite():
+    cols = updatedb.to_numeric(['1,234.5', 'inf', '-inf', 'nan', '--', '7'], np.float64)
+    assert list(cols.mask) == [False, True, True, True, True, False]
+    assert list(cols.compressed()) == [1234.5, 7.0]
+
+    cols = updatedb.to_numeric(['1', 'inf', 'X'], np.float64)
+    assert list(cols.mask) == [False, True, True]
+
+def test_to_numeric_masks_integer_overflow():
+    cols = updatedb.to_numeric(['9,223,372,036,854,775,808', '-99,999,999,999,999,999,999', '5,000', '99999999999999999999'], np.int64)
+    assert list(cols.mask) == [True, True, False, True]
+    assert list(cols.compressed()) == [5000]
+
+    cols = updatedb.to_numeric(['2147483648', '2147483647', '--'], np.int32)
+    assert list(cols.mask) == [True, False, True]
+
+BODY = '{"stat": "OK", "title": "a \\"quoted\\" } , \\\\ \\u53f0", "data5": [["2330", "1,000"]], "n": 12}'
+
+def chunked(text, *cuts):
+    cuts = (0,) + cuts + (len(text),)
+    return [text[a:b] for a, b in zip(cuts, cuts[1:])]
+
+def test_json_members_across_chunks():
+    whole = fetch.json_members([BODY], ['title', 'data5', 'n'])
+    assert whole == {'title': 'a "quoted" } , \\ \u53f0', 'data5': [['2330', '1,000']], 'n': 12}
+    # every cut, including inside strings, escapes and numbers
+    for i in range(len(BODY) + 1):
+        assert fetch.json_members(chunked(BODY, i), ['title', 'data5', 'n']) == whole
+    assert fetch.json_members(list(BODY), ['title', 'data5', 'n']) == whole
+
+def test_json_members_missing_keys():
+    assert fetch.json_members([BODY], ['stat', 'data9']) == {'stat': 'OK'}
+    assert fetch.json_members(['{}'], ['stat']) == {}
+    assert fetch.json_members([' { } '], []) == {}
+
+def test_json_members_rejects_other_bodies():
+    for body in ('[1, 2]', '<html></html>', '"OK"', '{"stat" "OK"}'):
+        with pytest.raises(ValueError):
+            fetch.json_members([body], ['stat'])
+
+def test_json_members_rejects_truncated_bodies():
+    for body in ('', '{', '{"n": 12', '{"n": 12 ', '{"stat": "OK", "n": 1'):
+        with pytest.raises(ValueError):
+            fetch.json_members([body], ['n'])
+
+    for i in range(len(BODY)):
+        with pytest.raises(ValueError):
+            fetch.json_members(chunked(BODY[:i], i // 2), ['n'])
+
+BIG = [
+    ['2330', 'TSMC', '3,000,000,000', '1', '216,000', '215.00', '217.00', '214.00', '216.00'],
+    ['2317', 'Hon Hai', '2,000', '1', '170,000', '85.00', '86.00', '84.00', '85.50'],
+]
+
+def test_counts_fit_their_columns():
+    twse = sources.select(['twse'])[0]
+    cols = updatedb.parse_price_info(twse, '20170621', BIG)
+    assert list(np.ma.getmaskarray(cols['traded_share'])) == [True, False]
+
+    # daily_price.traded_share is a bigint
+    cols = updatedb.parse_price_info(twse, '20170621', BIG, 'long')
+    assert list(cols['traded_share']) == [3000000000, 2000]
+
+    info = [['2330', 'TSMC', '0', '0', '2,147,483,648', '0', '0', '12', '0'],
+            ['2317', 'Hon Hai', '0', '0', '-5,000', '0', '0', '-2,147,483,649', '0']]
+    cols = updatedb.parse_trade_info(twse, '20170621', info)
+    assert list(np.ma.getmaskarray(cols['f_trade'])) == [True, False]
+    assert list(np.ma.getmaskarray(cols['l_trade'])) == [False, True]
+
+def test_oversized_count_skips_only_its_row(dbname):
+    twse = sources.select(['twse'])[0]
+    updatedb.write_price_info(dbname, updatedb.parse_price_info(twse, '20170621', BIG), 'table')
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        cursor.execute('select traded_share from "2317"')
+        assert cursor.fetchall() == [(2000,)]
+        cursor.execute('select to_regclass(\'"2330"\') is null')
+        assert cursor.fetchone()[0]
+        conn.commit()
+
+class BrokenPlan(object):
+    def status(self, date):
+        raise RuntimeError('planner lost its connection')
+
+def test_worker_error_stops_the_pipeline():
+    errors = []
+    def run():
+        try:
+            updatedb.pipeline('unused', datetime.datetime(2017, 6, 21), 3, jobs=2, plan=BrokenPlan(), markets=sources.select(['twse']))
+        except RuntimeError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert [str(e) for e in errors] == ['planner lost its connection']
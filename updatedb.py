@@ -4,12 +4,22 @@ import os
 import sys
 import traceback
 import datetime
-import psycopg2
-import getpass
-import requests
-import json
+from psycopg2 import sql
 import time
+import numpy as np
 import logging
+import warnings
+import threading
+import queue
+from collections import OrderedDict
+import db
+import planner
+import indicators
+import adjust
+import cache
+import metrics
+import fetch
+import sources
 
 def parser():
     import argparse
@@ -18,176 +28,557 @@ def parser():
     parser.add_argument('dbname', type=str, help='DB name to operate')
     parser.add_argument('-d', '--date', type=str, help='Date format YYYYMMDD (ex. 20170621)')
     parser.add_argument('-c', '--count', type=int, help='Number traded date')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of dates fetched concurrently')
+    parser.add_argument('-r', '--rate', type=float, default=2.0, help='Max requests per second sent to each market when --jobs > 1')
+    parser.add_argument('-p', '--parsers', type=int, default=1, help='Number of parser threads between the fetchers and the writer')
+    parser.add_argument('-b', '--batch', type=int, default=5, help='Max days written per transaction')
+    parser.add_argument('-q', '--queue-size', type=int, default=8, help='Max days waiting between two stages')
+    parser.add_argument('-s', '--storage', choices=['table', 'long'], default='table', help='Store one table per stock (table) or all stocks in the partitioned daily_price table (long)')
+    parser.add_argument('-m', '--markets', nargs='+', choices=list(sources.registry), help='Markets to ingest (default all of %s)' % ', '.join(sources.registry))
+    parser.add_argument('--base-url', type=str, help='Fetch every market from this host instead of its own (ex. http://localhost:8000)')
+    parser.add_argument('--refetch', action='store_true', help='Fetch every date, even those already in the database')
+    parser.add_argument('--cache-dir', type=str, default='cache', help='Directory of cached market responses')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Cache size limit in MB, 0 disables the cache')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached responses and fetch again')
+    parser.add_argument('--retries', type=int, default=3, help='Retries with exponential backoff per request')
+    parser.add_argument('--indicators', action='store_true', help='Update the materialized indicators after ingesting')
+    parser.add_argument('--adjust', action='store_true', help='Update the split and dividend adjusted prices after ingesting')
+    parser.add_argument('--metrics', type=str, help='Write a JSON summary of counters and timings to this file, - for stdout')
+    parser.add_argument('--prometheus', type=str, help='Write the metrics as a Prometheus textfile (ex. /var/lib/node_exporter/stock.prom)')
     parser.add_argument('-f', '--log-file', nargs='?', default='default', help='Enable logging to a file, omit default log file')
 
     return parser
 
-def get_tse_price_info(date):
-    url = 'http://www.twse.com.tw/exchangeReport/MI_INDEX'
+# response cache and keep-alive session, set up by main()
+response_cache = None
+fetcher = fetch.PageFetcher(retries=3)
 
-    query_params = {
-        'date': date,
-        'response': 'json',
-        'type': 'ALL',
-        '_': str(round(time.time() * 1000) - 500)
-    }
+# per-stock tables already known to carry f_trade/l_trade in this run
+trade_ready = set()
+
+# per-stock tables already known to be keyed on date in this run
+keyed = set()
 
-    page = requests.get(url, params=query_params)
+def get_json(url, query_params, keys, date, answered=None):
+    # only the wanted top-level keys are decoded, the rest of the reply is
+    # skipped while it streams in; answered(content) tells a real reply from
+    # an empty or throttled one, which never goes in the cache
+    source = url.rsplit('/', 1)[-1]
+    if response_cache:
+        content = response_cache.get(url, query_params)
+        if content is not None and (answered is None or answered(content)):
+            metrics.inc('cache_hits', source=source)
+            return content
 
-    if not page.ok:
-        logging.error('Can\'t get %s' % page.url)
+    with metrics.timer('fetch', source=source, date=date):
+        content = fetcher.get_members(url, query_params, keys)
+
+    if content is None:
         return None
 
-    content = page.json()
+    if answered is not None and not answered(content):
+        return content
 
-    try:
-        data = content['data5']
-    except KeyError as e:
-        logging.error('No \'data5\' key in %s' % page.url)
+    # a closed session never changes, but today's report may still be filling in
+    if response_cache and date < datetime.datetime.now().strftime('%Y%m%d'):
+        response_cache.put(url, query_params, content)
+
+    return content
+
+def get_rows(source, report, date, missing=None):
+    # rows of one of a market's daily reports, None when the fetch failed
+    url = source.endpoint(report)
+    content = get_json(url, report.query(date), report.members(), date, report.answered)
+    if content is None:
         return None
 
-    return data
+    # a throttled reply, or one without the rows, says nothing about the
+    # session, try again next run
+    if not report.answered(content):
+        logging.error('%s: %s: no \'%s\' answer from %s' % (source.name, date, report.key, url))
+        return None
 
-def update_price_info(dbname, date, data):
-    for row in data:
-        # retrieve data and transfer to suited type
-        stockno = row[0]
-        numlist = row[2].split(',')
-        tmp = ""
-        for num in numlist:
-            tmp += num
-        try:
-            traded_share = int(tmp)
-            open_p = float(row[5])
-            high_p = float(row[6])
-            low_p = float(row[7])
-            close_p = float(row[8])
-        except ValueError as e:
-            logging.error('%s: %s: price data can\'t convert' % (stockno, date))
-            continue
-
-        #print('%s,%s,%d,%f,%f,%f,%f' % (date, stockno, traded_share, open_p, high_p, low_p, close_p))
-        conn = psycopg2.connect(database=dbname, user=getpass.getuser())
-        cursor = conn.cursor()
+    if report.key in content:
+        return content[report.key]
 
-        # check if table exist
-        cmd = 'select exists ( select 1 from information_schema.tables where table_name = \'%s\' )' % stockno
-        cursor.execute(cmd)
-        rows = cursor.fetchall()
-        for row in rows:
-            if not row[0]:
-                # not exist, create table
-                cmd = 'create table "%s" ( date date, traded_share integer, open real, high real, low real, close real )' % stockno
-                cursor.execute(cmd)
-                conn.commit()
-                break
+    # only the report's no-data notice gets here
+    return missing
 
-        # check if row exist
-        cmd = 'select exists ( select 1 from "%s" where date = \'%s\' and open > 0 and high > 0 and low > 0 and close > 0 )' % (stockno, date)
-        cursor.execute(cmd)
-        rows = cursor.fetchall()
-        for row in rows:
-            if not row[0]:
-                cmd = 'insert into "%s" values ( \'%s\', %d, %f, %f, %f, %f )' % (stockno, date, traded_share, open_p, high_p, low_p, close_p)
-                cursor.execute(cmd)
-                break
+def get_price_info(source, date):
+    # an empty list tells a closed market apart from a failed fetch
+    return get_rows(source, source.price, date, [])
 
-        conn.commit()
-        conn.close()
+PRICE_FIELDS = ('traded_share', 'open', 'high', 'low', 'close')
 
-def get_tse_trade_info(date):
-    url = 'http://www.twse.com.tw/fund/T86'
+# numpy type of the counts per storage mode, no wider than their columns
+# so a value that doesn't fit is masked instead of failing the whole batch
+FIELD_TYPES = {
+    'table': {'traded_share': np.int32, 'f_trade': np.int32, 'l_trade': np.int32},
+    'long': {'traded_share': np.int64, 'f_trade': np.int32, 'l_trade': np.int32},
+}
 
-    query_params = {
-        'date': date,
-        'response': 'json',
-        'selectType': 'ALL',
-        '_': str(round(time.time() * 1000) - 500)
+def field_type(name, storage='table'):
+    return FIELD_TYPES[storage].get(name, np.float64)
+
+def to_numeric(cells, dtype):
+    # converts a whole column of strings at once, cells that aren't numbers (ex. '--') come back masked
+    if len(cells) == 0:
+        return np.ma.masked_array(np.zeros(0, dtype=dtype), np.zeros(0, dtype=bool))
+
+    # fast path: parse the column as one text blob in C, '--' reads as nan
+    text = '\n'.join(cells).replace(',', '').replace('--', 'nan')
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(text, sep='\n')
+    except ValueError:
+        values = ()
+
+    if len(values) == len(cells):
+        # fromstring also reads 'inf', none of that is a price
+        invalid = ~np.isfinite(values)
+    else:
+        # some other junk in the column, check every cell
+        clean = np.char.replace(np.char.strip(np.array(cells, dtype=str)), ',', '')
+        digits = np.char.replace(np.char.lstrip(clean, '+-'), '.', '', count=1)
+        invalid = ~np.char.isdigit(digits)
+        values = np.zeros(len(cells))
+        values[~invalid] = clean[~invalid].astype(np.float64)
+
+    if np.issubdtype(dtype, np.integer):
+        # too big for dtype would wrap around silently
+        info = np.iinfo(dtype)
+        invalid |= (values < info.min) | (values >= float(info.max) + 1)
+
+    values[invalid] = 0
+
+    return np.ma.masked_array(values.astype(dtype), invalid)
+
+def parse_price_batch(source, days, storage='table'):
+    # days are ( date, rows ) pairs of one market, all rows are converted in one pass
+    report = source.price
+    dates = []
+    rows = []
+    for date, data in days:
+        data = report.parse(data) if report.parse else data
+        dates += [date] * len(data)
+        rows += data
+
+    table = list(zip(*rows)) if rows else [()] * report.width()
+    columns = report.columns
+    cols = {
+        'stockno': np.array(table[columns['stockno']], dtype=str),
+        'date': np.array(dates, dtype=str),
     }
+    for name in PRICE_FIELDS:
+        cols[name] = to_numeric(table[columns[name]], field_type(name, storage))
 
-    page = requests.get(url, params=query_params)
+    for i in np.flatnonzero(invalid_rows(cols, PRICE_FIELDS)):
+        logging.error('%s: %s: price data can\'t convert' % (cols['stockno'][i], cols['date'][i]))
+        metrics.inc('rows', dataset=source.dataset('price'), action='invalid', date=cols['date'][i])
 
-    if not page.ok:
-        logging.error('Can\'t get %s' % page.url)
-        return None
+    return cols
 
-    content = page.json()
+def parse_price_info(source, date, data, storage='table'):
+    with metrics.timer('parse', dataset=source.dataset('price'), date=date):
+        return parse_price_batch(source, [(date, data)], storage)
 
-    try:
-        data = content['data']
-    except KeyError as e:
-        logging.error('No \'data\' key in %s' % page.url)
-        return None
+def invalid_rows(cols, fields):
+    invalid = np.zeros(len(cols['stockno']), dtype=bool)
+    for name in fields:
+        invalid |= np.ma.getmaskarray(cols[name])
 
-    return data
+    return invalid
 
-def update_trade_info(dbname, date, data):
-    for d in data:
-        exist = True
-        stockno = d[0]
-        try:
-            numlist = d[4].split(',')
-            tmp = ""
-            for num in numlist:
-                tmp += num
-            f_trade = int(tmp)
-            numlist = d[7].split(',')
-            tmp = ""
-            for num in numlist:
-                tmp += num
-            l_trade = int(tmp)
-        except ValueError as e:
-            logging.error('%s: %s: trade info can\'t convert' % (stockno, date))
-            continue
-
-        #print('%s: f_trade = %d, l_trade = %d' % (stockno, f_trade, l_trade))
-        conn = psycopg2.connect(database=dbname, user=getpass.getuser())
+def valid_records(cols, fields):
+    # rows with a masked cell are left out, values come back as python types
+    valid = ~invalid_rows(cols, fields)
+    columns = [cols['stockno'][valid].tolist(), cols['date'][valid].tolist()]
+    columns += [np.ma.getdata(cols[name])[valid].tolist() for name in fields]
+
+    return list(zip(*columns))
+
+def write_price_info(dbname, cols, storage='table', dataset='price'):
+    records = valid_records(cols, PRICE_FIELDS)
+    if not records:
+        return
+
+    # the whole batch goes in one transaction on a pooled connection
+    with db.connection(dbname) as conn:
         cursor = conn.cursor()
 
-        # check if table exist
-        cmd = 'select exists ( select 1 from information_schema.tables where table_name = \'%s\' )' % stockno
-        cursor.execute(cmd)
-        rows = cursor.fetchall()
-        for row in rows:
-            if not row[0]:
-                exist = False
-                break
+        counts = date_counts(records)
+        date = min(counts) if len(counts) == 1 else 'batch'
+        with metrics.timer('write', dataset=dataset, date=date):
+            if storage == 'long':
+                written = db.copy_daily_price(cursor, records)
+                metrics.inc('rows', written, dataset=dataset, action='written', date=date)
+                metrics.inc('rows', len(records) - written, dataset=dataset, action='skipped', date=date)
+            else:
+                # one batched statement, the server only reports its last rowcount
+                write_price_tables(cursor, records)
+                for d, n in counts.items():
+                    metrics.inc('rows', n, dataset=dataset, action='sent', date=d)
+
+            planner.log_datasets(cursor, storage, dataset, counts)
+            conn.commit()
+
+PRICE_TABLE = 'create table {} ( date date primary key, traded_share integer, open real, high real, low real, close real, f_trade integer, l_trade integer )'
+# a row stored with invalid prices is replaced, a valid one is kept
+PRICE_UPSERT = 'insert into {t} ( date, traded_share, open, high, low, close ) values ( %s, %s, %s, %s, %s, %s ) on conflict ( date ) do update set traded_share = excluded.traded_share, open = excluded.open, high = excluded.high, low = excluded.low, close = excluded.close where not ( {t}.open > 0 and {t}.high > 0 and {t}.low > 0 and {t}.close > 0 )'
+TRADE_UPDATE = 'update {t} set f_trade = %s, l_trade = %s where date = %s and ( f_trade is null or l_trade is null )'
+
+def write_price_tables(cursor, records):
+    # check which tables exist with a single probe
+    cmd = 'select table_name from information_schema.tables where table_name in %s'
+    cursor.execute(cmd, (tuple(r[0] for r in records),))
+    exists = set(row[0] for row in cursor.fetchall())
+
+    # tables from before date was the key get deduplicated first
+    db.ensure_date_keys(cursor, exists - keyed)
+    keyed.update(exists)
+
+    new = sorted(set(r[0] for r in records) - exists)
+    if new:
+        # not exist, create table
+        cursor.execute(sql.SQL(';\n').join(sql.SQL(PRICE_TABLE).format(db.ident(s)) for s in new))
+        keyed.update(new)
+        trade_ready.update(new)
+
+    # an upsert per table, all sent in a single round trip
+    db.execute_tables(cursor, PRICE_UPSERT, [(r[0], r[1:]) for r in records])
+
+def date_counts(records):
+    counts = {}
+    for r in records:
+        counts[r[1]] = counts.get(r[1], 0) + 1
+
+    return counts
+
+def get_trade_info(source, date):
+    return get_rows(source, source.trade, date)
+
+def parse_trade_info(source, date, data):
+    start = time.time()
+    dataset = source.dataset('trade')
+    report = source.trade
+    data = report.parse(data) if report.parse else data
+    table = list(zip(*data)) if data else [()] * report.width()
+    cols = {
+        'stockno': np.array(table[report.columns['stockno']], dtype=str),
+        'date': np.full(len(data), date),
+        'f_trade': to_numeric(table[report.columns['f_trade']], field_type('f_trade')),
+        'l_trade': to_numeric(table[report.columns['l_trade']], field_type('l_trade')),
+    }
 
-        if not exist:
-            conn.close()
-            continue
-
-        # check if column created
-        cmd = 'select exists ( select 1 from information_schema.columns where table_name = \'%s\' and column_name = \'f_trade\' )' % (stockno)
-        cursor.execute(cmd)
-        rows = cursor.fetchall()
-        for row in rows:
-            if not row[0]:
-                cmd = 'alter table "%s" add column f_trade integer' % stockno
-                cursor.execute(cmd)
-                cmd = 'alter table "%s" add column l_trade integer' % stockno
-                cursor.execute(cmd)
-                conn.commit()
-                break
+    for i in np.flatnonzero(invalid_rows(cols, ('f_trade', 'l_trade'))):
+        logging.error('%s: %s: trade info can\'t convert' % (cols['stockno'][i], date))
+        metrics.inc('rows', dataset=dataset, action='invalid', date=date)
 
-        # check if f_trade and l_trade column are filled
-        cmd = 'select exists ( select 1 from "%s" where date =\'%s\' and f_trade is not null and l_trade is not null )' % (stockno, date)
-        cursor.execute(cmd)
-        rows = cursor.fetchall()
-        for row in rows:
-            if row[0]:
-                exist = False
-                break
+    metrics.observe('parse', time.time() - start, dataset=dataset, date=date)
+    return cols
+
+def add_trade_columns(cursor, stocknos):
+    missing = set(stocknos) - trade_ready
+    if not missing:
+        return
+
+    # one probe for every table we haven't seen yet
+    cmd = 'select table_name from information_schema.columns where table_name in %s and column_name = \'f_trade\''
+    cursor.execute(cmd, (tuple(missing),))
+    has_column = set(row[0] for row in cursor.fetchall())
 
-        if not exist:
-            conn.close()
-            continue
+    cmds = []
+    for stockno in sorted(missing - has_column):
+        cmds.append(sql.SQL('alter table {} add column f_trade integer, add column l_trade integer').format(db.ident(stockno)))
+    if cmds:
+        cursor.execute(sql.SQL(';\n').join(cmds))
 
-        # update the row's f_trade and l_trade info
-        cmd = 'update "%s" set f_trade = %d, l_trade = %d where date = \'%s\'' % (stockno, f_trade, l_trade, date)
-        cursor.execute(cmd)
+    trade_ready.update(missing)
+
+def write_trade_info(dbname, date, cols, storage='table', dataset='trade'):
+    values = [(r[0], r[2], r[3]) for r in valid_records(cols, ('f_trade', 'l_trade'))]
+    if not values:
+        return
+
+    with db.connection(dbname) as conn, metrics.timer('write', dataset=dataset, date=date):
+        cursor = conn.cursor()
+
+        if storage == 'long':
+            db.stage_trade(cursor, date, values)
+            db.create_daily_price(cursor)
+            cmd = 'update daily_price d set f_trade = s.f_trade, l_trade = s.l_trade from trade_stage s where d.stockno = s.stockno and d.date = s.date and ( d.f_trade is null or d.l_trade is null )'
+            cursor.execute(cmd)
+            metrics.inc('rows', cursor.rowcount, dataset=dataset, action='written', date=date)
+            metrics.inc('rows', len(values) - cursor.rowcount, dataset=dataset, action='skipped', date=date)
+        elif not merge_trade_tables(cursor, date, values):
+            return
+        else:
+            metrics.inc('rows', len(values), dataset=dataset, action='sent', date=date)
+
+        planner.log_datasets(cursor, storage, dataset, {date: len(values)})
         conn.commit()
-        conn.close()
+
+def merge_trade_tables(cursor, date, values):
+    # only stocks that have a table get their trade info
+    cmd = 'select table_name from information_schema.tables where table_name in %s'
+    cursor.execute(cmd, (tuple(v[0] for v in values),))
+    stocknos = set(row[0] for row in cursor.fetchall())
+    if not stocknos:
+        return False
+
+    add_trade_columns(cursor, stocknos)
+
+    # an update per table, all sent in one round trip
+    db.execute_tables(cursor, TRADE_UPDATE, [(v[0], (v[1], v[2], date)) for v in values if v[0] in stocknos])
+
+    return True
+
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # hand out evenly spaced slots to all threads
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+def fetch_day(source, date, limiter, done={}):
+    # done holds the datasets the database already has for date
+    price = source.dataset('price')
+    data = None
+    info = None
+    try:
+        if price not in done:
+            limiter.wait()
+            data = get_price_info(source, date)
+            # non-trading day, don't bother asking for the trades
+            if not data:
+                return date, data, None
+        elif not done[price]:
+            return date, None, None
+
+        if source.dataset('trade') not in done:
+            limiter.wait()
+            info = get_trade_info(source, date)
+    except Exception as e:
+        logging.error('%s: %s: fetch failed: %s' % (source.name, date, e))
+        return date, None, None
+
+    return date, data, info
+
+def parse_day(source, date, data, info, done={}, storage='table'):
+    # price and trade columns of a fetched day, None where there is nothing to write
+    prices = None
+    trades = None
+    if data and source.dataset('price') not in done:
+        prices = parse_price_info(source, date, data, storage)
+    if info:
+        trades = parse_trade_info(source, date, info)
+
+    return prices, trades
+
+def is_trading(source, data, done={}):
+    price = source.dataset('price')
+    if price in done:
+        return done[price] > 0
+
+    return bool(data)
+
+def concat_cols(parts):
+    if len(parts) == 1:
+        return parts[0]
+
+    cols = {}
+    for name, col in parts[0].items():
+        if isinstance(col, np.ma.MaskedArray):
+            cols[name] = np.ma.concatenate([p[name] for p in parts])
+        else:
+            cols[name] = np.concatenate([p[name] for p in parts])
+
+    return cols
+
+def write_days(dbname, days, storage='table'):
+    # days are ( source, date, data, prices, trades, done ), the prices of
+    # all of them go in one transaction, trades follow once their rows exist
+    prices = OrderedDict()
+    for source, date, data, cols, trades, done in days:
+        if source.dataset('price') in done:
+            metrics.inc('dates', state='planned_skip', market=source.name)
+        elif data is None:
+            metrics.inc('dates', state='failed', market=source.name)
+        elif not data:
+            planner.mark_closed(dbname, storage, date, source.dataset('price'))
+            metrics.inc('dates', state='closed', market=source.name)
+
+        if is_trading(source, data, done):
+            metrics.inc('dates', state='trading', market=source.name)
+        if cols is not None:
+            prices.setdefault(source.dataset('price'), []).append(cols)
+
+    # one write per market keeps the ingest log of each apart
+    for dataset, parts in prices.items():
+        write_price_info(dbname, concat_cols(parts), storage, dataset)
+
+    for source, date, data, cols, trades, done in days:
+        if trades is not None and is_trading(source, data, done):
+            write_trade_info(dbname, date, trades, storage, source.dataset('trade'))
+
+class Channel(object):
+    # bounded queue between two stages, a full one holds back the stage
+    # before it; waits and depths go to the metrics
+    def __init__(self, name, size, stop):
+        self.name = name
+        self.queue = queue.Queue(maxsize=size)
+        self.stop = stop
+
+    def put(self, item):
+        # False once the run is over
+        start = time.time()
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            metrics.observe('queue_wait', time.time() - start, queue=self.name, side='put')
+            metrics.sample('queue_depth', self.queue.qsize(), queue=self.name)
+            return True
+
+        return False
+
+    def get(self):
+        # None once the run is over
+        start = time.time()
+        while not self.stop.is_set():
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            metrics.observe('queue_wait', time.time() - start, queue=self.name, side='get')
+            return item
+
+        return None
+
+    def ready(self):
+        items = []
+        try:
+            while True:
+                items.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        return items
+
+def pipeline(dbname, datetime_obj, count, jobs=1, parsers=1, rate=0, storage='table', plan=None, queue_size=8, batch=5, markets=None):
+    # fetchers -> fetched -> parsers -> parsed -> a single writer, so the
+    # network, the parsing and the database all stay busy at once; a unit
+    # of work is one market's date, all markets share the workers and the
+    # connections while each host keeps its own rate limit
+    markets = markets or sources.select()
+    limiters = dict((source.name, RateLimiter(rate)) for source in markets)
+    stop = threading.Event()
+    fetched = Channel('fetched', queue_size, stop)
+    parsed = Channel('parsed', queue_size, stop)
+    # bounds how far the fetchers may run ahead of the writer, a slow date
+    # can't make the rest pile up behind it
+    window = threading.Semaphore(queue_size * 2 + jobs + parsers)
+    date_lock = threading.Lock()
+    state = {'index': 0}
+    # the first error of a worker, raised again by the writer
+    failed = []
+
+    def next_unit():
+        with date_lock:
+            index = state['index']
+            state['index'] += 1
+            source = markets[index % len(markets)]
+            date = (datetime_obj - datetime.timedelta(index // len(markets))).strftime('%Y%m%d')
+            done = plan.status(date) if plan else {}
+
+        return index, source, date, done
+
+    def fetch_worker():
+        while True:
+            window.acquire()
+            if stop.is_set():
+                break
+            index, source, date, done = next_unit()
+            if not fetched.put((index, source) + fetch_day(source, date, limiters[source.name], done) + (done,)):
+                break
+
+    def parse_worker():
+        while True:
+            item = fetched.get()
+            if item is None:
+                break
+            index, source, date, data, info, done = item
+            try:
+                prices, trades = parse_day(source, date, data, info, done, storage)
+            except Exception as e:
+                logging.error('%s: %s: parse failed: %s' % (source.name, date, e))
+                data, prices, trades = None, None, None
+            if not parsed.put((index, (source, date, data, prices, trades, done))):
+                break
+
+    def guarded(worker):
+        # a dead worker would leave the writer waiting forever, stop the run instead
+        def run():
+            try:
+                worker()
+            except Exception as e:
+                logging.error('%s failed: %s' % (worker.__name__, e))
+                failed.append(e)
+                stop.set()
+
+        return run
+
+    fetchers = [threading.Thread(target=guarded(fetch_worker), daemon=True) for i in range(jobs)]
+    threads = fetchers + [threading.Thread(target=guarded(parse_worker), daemon=True) for i in range(parsers)]
+    for t in threads:
+        t.start()
+
+    # days are written newest first just like a serial run, whatever is
+    # ready goes out in batches of up to batch days of every market; a date
+    # counts as trading once any market had a session
+    pending = {}
+    expected = 0
+    getnum = 0
+    traded = False
+    try:
+        while getnum <= count:
+            item = parsed.get()
+            if item is None:
+                raise failed[0]
+            index, day = item
+            pending[index] = day
+            pending.update(parsed.ready())
+            metrics.sample('queue_depth', len(pending), queue='reorder')
+
+            while expected in pending and getnum <= count:
+                days = []
+                while expected in pending and getnum <= count and len(days) < batch * len(markets):
+                    day = pending.pop(expected)
+                    expected += 1
+                    window.release()
+                    days.append(day)
+                    traded = traded or is_trading(day[0], day[2], day[5])
+                    if expected % len(markets) == 0:
+                        getnum += 1 if traded else 0
+                        traded = False
+                write_days(dbname, days, storage)
+    finally:
+        stop.set()
+        for t in fetchers:
+            window.release()
+        for t in threads:
+            t.join()
 
 def main(argv):
     args = parser().parse_args(argv[1:])
@@ -217,10 +608,17 @@ def main(argv):
         logging.error('Invalid Date: %s' % date)
         sys.exit(1)
 
+    global response_cache, fetcher
+    markets = sources.select(args.markets, args.base_url)
+
+    fetcher = fetch.PageFetcher(per_host=max(args.jobs, 1), retries=args.retries)
+
+    if args.cache_size > 0:
+        response_cache = cache.ResponseCache(args.cache_dir, args.cache_size << 20, args.refresh)
+
     # check dbname
     try:
-        conn = psycopg2.connect(database=args.dbname, user=getpass.getuser())
-        conn.close()
+        db.put_conn(args.dbname, db.get_conn(args.dbname))
     except Exception as e:
         logging.error('Database Error: %s' % e)
         sys.exit(1)
@@ -230,19 +628,26 @@ def main(argv):
     else:
         count = 0
 
-    getnum = 0
-    while getnum <= count:
-        date = datetime_obj.strftime('%Y%m%d')
-        # get json data
-        data = get_tse_price_info(date)
-        if data:
-            update_price_info(args.dbname, date, data)
-            info = get_tse_trade_info(date)
-            if info:
-                update_trade_info(args.dbname, date, info)
-            getnum += 1
-
-        datetime_obj -= datetime.timedelta(1)
+    # only fetch what the database doesn't have yet
+    if args.refetch:
+        plan = None
+    else:
+        plan = planner.Planner(args.dbname, args.storage, count * 2 + 14)
+
+    rate = args.rate if args.jobs > 1 else 0
+    pipeline(args.dbname, datetime_obj, count, args.jobs, args.parsers, rate, args.storage, plan,
+             args.queue_size, args.batch, markets)
+
+    if args.indicators:
+        with metrics.timer('indicators'):
+            indicators.update(args.dbname)
+
+    if args.adjust:
+        with metrics.timer('adjust'):
+            adjust.update(args.dbname)
+
+    metrics.emit(args.metrics, args.prometheus, 'stock_updatedb')
+    db.close_all()
 
 if __name__ == '__main__':
     try:
@@ -1,302 +1,383 @@
 #!/usr/bin/env python
 import sys
 import traceback
-import requests
 import argparse
 import os
+import io
+import time
 import logging
-import psycopg2
-import getpass
 from datetime import datetime
+from urllib.parse import urlsplit, urlunsplit
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from bs4 import BeautifulSoup
+from lxml import etree
+from psycopg2 import sql
+import db
+import fetch
+import metrics
 
 def parser():
     parser = argparse.ArgumentParser(description='Create/Update U.S. yield table')
     parser.add_argument('dbname', type=str, help='DB name')
+    parser.add_argument('-s', '--storage', choices=['table', 'long'], default='table', help='Store DEBY/BADI/DXY/MOO/RSX in their own tables (table) or all of them in the macro_price table (long)')
+    parser.add_argument('--full', action='store_true', help='Reload the whole USTY history instead of only dates after the latest stored one')
+    parser.add_argument('--browser', action='store_true', help='Render the investing/yahoo pages with PhantomJS instead of plain HTTP')
+    parser.add_argument('-t', '--timeout', type=int, default=120, help='Seconds before a source still fetching or parsing is given up')
+    parser.add_argument('--retries', type=int, default=2, help='Times a failed fetch is retried')
+    parser.add_argument('-w', '--parse-workers', type=int, help='Processes parsing pages, default CPU count')
+    parser.add_argument('--per-host', type=int, default=2, help='Max concurrent requests per host')
+    parser.add_argument('--base-url', type=str, help='Fetch every source from this host instead (ex. http://localhost:8000)')
+    parser.add_argument('--metrics', type=str, help='Write a JSON summary of counters and timings to this file, - for stdout')
+    parser.add_argument('--prometheus', type=str, help='Write the metrics as a Prometheus textfile (ex. /var/lib/node_exporter/updatetbl.prom)')
     parser.add_argument('-f', '--log-file', nargs='?', default='default', help='Enable logging to a file, omit default log file')
 
     return parser
 
+# replaces the scheme and host of every source, set up by main()
+base_url = None
+
+def rebase(url):
+    if not base_url:
+        return url
+
+    parts = urlsplit(url)
+    return urlunsplit(urlsplit(base_url)[:2] + parts[2:])
+
+# shared by every fetch of the run, set up by main() or on first use
+fetcher = None
+
+def get_fetcher():
+    global fetcher
+    if fetcher is None:
+        fetcher = fetch.PageFetcher(per_host=len(SOURCES) + 1)
+
+    return fetcher
+
+USTY_URL = 'https://www.treasury.gov/resource-center/data-chart-center/interest-rates/Datasets/yield.xml'
+
 def get_USTY():
-    url = 'https://www.treasury.gov/resource-center/data-chart-center/interest-rates/Datasets/yield.xml'
+    return get_fetcher().get(rebase(USTY_URL), binary=True)
 
-    page = requests.get(url)
+USTY_TAGS = ('BC_1MONTH', 'BC_3MONTH', 'BC_6MONTH', 'BC_1YEAR', 'BC_2YEAR', 'BC_3YEAR',
+             'BC_5YEAR', 'BC_7YEAR', 'BC_10YEAR', 'BC_20YEAR', 'BC_30YEAR')
+USTY_COLUMNS = ('m1', 'm3', 'm6', 'y1', 'y2', 'y3', 'y5', 'y7', 'y10', 'y20', 'y30')
 
-    if not page.ok:
-        logging.error('Can\'t get USTY from %s: %s' % (url, page.reason))
-        return None
+def iter_USTY(xml_doc):
+    # stream G_NEW_DATE elements, memory stays flat however long the history is
+    for event, elem in etree.iterparse(io.BytesIO(xml_doc), events=('end',), tag='{*}G_NEW_DATE'):
+        cells = {}
+        for child in elem.iter():
+            if child is not elem:
+                cells[etree.QName(child).localname] = (child.text or '').strip()
 
-    return page.content
+        # drop what we've read so far
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
-def update_USTY_tbl(dbname, tbl_name, xml_doc):
-    soup = BeautifulSoup(xml_doc, 'lxml-xml')
-    dates = soup.find_all('G_NEW_DATE')
+        try:
+            dt_str = datetime.strptime(cells['BID_CURVE_DATE'], '%d-%b-%y').strftime('%Y%m%d')
+        except (KeyError, ValueError) as e:
+            logging.error('USTY: bad BID_CURVE_DATE %s' % cells.get('BID_CURVE_DATE'))
+            continue
+
+        try:
+            yield dt_str, tuple(float(cells[tag]) for tag in USTY_TAGS)
+        except (KeyError, ValueError) as e:
+            logging.error('%s: date can\'t convert' % dt_str)
 
-    conn = psycopg2.connect(database=dbname, user=getpass.getuser())
-    cursor = conn.cursor()
-    cmd = 'select exists ( select 1 from information_schema.tables where table_name = \'%s\' )' % tbl_name
+def create_USTY_tbl(cursor, tbl_name):
+    cmd = sql.SQL('create table if not exists {} ( date date primary key, {} )').format(db.ident(tbl_name), sql.SQL(', ').join(sql.SQL('{} real').format(db.ident(c)) for c in USTY_COLUMNS))
     cursor.execute(cmd)
-    rows = cursor.fetchall()
-    for row in rows:
-        if not row[0]:
-            # not exist, create table
-            cmd = 'create table "%s" ( date date, m1 real, m3 real, m6 real, y1 real, y2 real, y3 real, y5 real, y7 real, y10 real, y20 real, y30 real )' % tbl_name
-            cursor.execute(cmd)
-            conn.commit()
+    db.ensure_date_keys(cursor, [tbl_name])
+
+def upsert_rows(cursor, tbl_name, columns, records):
+    # records are ( YYYYMMDD, ( values ) ), the first row of a date wins
+    rows = {}
+    for date, values in records:
+        rows.setdefault(date, (date,) + tuple(values))
+
+    cmd = sql.SQL('insert into {t} ( date, {cols} ) values %s on conflict ( date ) do update set {updates}').format(
+        t=db.ident(tbl_name), cols=sql.SQL(', ').join(db.ident(c) for c in columns),
+        updates=sql.SQL(', ').join(sql.SQL('{c} = excluded.{c}').format(c=db.ident(c)) for c in columns))
+    db.execute_values(cursor, cmd, [rows[d] for d in sorted(rows)])
+
+def get_USTY_latest(dbname, tbl_name):
+    # newest date with a complete curve, YYYYMMDD or None
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        create_USTY_tbl(cursor, tbl_name)
+        cmd = sql.SQL('select to_char(max(date), \'YYYYMMDD\') from {} where {}').format(db.ident(tbl_name), sql.SQL(' and ').join(sql.SQL('{} is not null').format(db.ident(c)) for c in USTY_COLUMNS))
+        cursor.execute(cmd)
+        latest = cursor.fetchone()[0]
+        conn.commit()
+
+    return latest
 
-    for date in dates:
-        date_str = date.find('BID_CURVE_DATE').get_text(strip=True)
-        dt = datetime.strptime(date_str, '%d-%b-%y')
-        dt_str = dt.strftime('%Y%m%d')
-        m1_str = date.find('BC_1MONTH').get_text(strip=True)
-        m3_str = date.find('BC_3MONTH').get_text(strip=True)
-        m6_str = date.find('BC_6MONTH').get_text(strip=True)
-        y1_str = date.find('BC_1YEAR').get_text(strip=True)
-        y2_str = date.find('BC_2YEAR').get_text(strip=True)
-        y3_str = date.find('BC_3YEAR').get_text(strip=True)
-        y5_str = date.find('BC_5YEAR').get_text(strip=True)
-        y7_str = date.find('BC_7YEAR').get_text(strip=True)
-        y10_str = date.find('BC_10YEAR').get_text(strip=True)
-        y20_str = date.find('BC_20YEAR').get_text(strip=True)
-        y30_str = date.find('BC_30YEAR').get_text(strip=True)
+def parse_USTY(xml_doc, latest=None):
+    # ( YYYYMMDD, m1, ..., y30 ) records newer than latest
+    records = []
+    for dt_str, values in iter_USTY(xml_doc):
+        if latest and dt_str <= latest:
+            continue
+        records.append((dt_str,) + values)
+
+    return records
+
+def write_USTY(dbname, tbl_name, records):
+    if not records:
+        return
+
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
+        create_USTY_tbl(cursor, tbl_name)
+
+        upsert_rows(cursor, tbl_name, USTY_COLUMNS, [(r[0], r[1:]) for r in records])
+        conn.commit()
+
+def update_USTY_tbl(dbname, tbl_name, xml_doc, incremental=True):
+    latest = get_USTY_latest(dbname, tbl_name) if incremental else None
+    write_USTY(dbname, tbl_name, parse_USTY(xml_doc, latest))
+
+def get_page(url, js=False):
+    # plain HTTP unless the page needs a browser to render
+    return get_fetcher().get(rebase(url), js)
+
+# How to read each kind of history page. 'rows' is a CSS selector for the
+# table rows, 'cells' names the <td>s in page order (None skips a cell).
+TABLE_SPECS = {
+    'investing': {
+        'rows': 'table.genTbl.closedTbl.historicalTbl > tbody > tr',
+        'date_format': '%b %d, %Y',
+        'cells': ('date', 'close', 'open', 'high', 'low'),
+    },
+    'investing-mobile': {
+        'rows': 'table.instHistoryTbl > tbody.js-history-data > tr',
+        'date_format': '%b %d, %Y',
+        'cells': ('date', 'close', 'open', 'high', 'low'),
+    },
+    'yahoo': {
+        'rows': 'tr.BdT',
+        'date_format': '%b %d, %Y',
+        'cells': ('date', 'open', 'high', 'low', 'close', None, 'volume'),
+    },
+}
+
+TABLE_COLUMNS = ('open', 'high', 'low', 'close', 'volume')
+
+def spec_columns(spec):
+    return tuple(c for c in TABLE_COLUMNS if c in spec['cells'])
+
+def parse_table(spec, html_doc):
+    # returns ( YYYYMMDD, values ) with values ordered as spec_columns(spec)
+    columns = spec_columns(spec)
+    soup = BeautifulSoup(html_doc, 'lxml')
+    records = []
+
+    for tr in soup.select(spec['rows']):
+        texts = [td.get_text(strip=True) for td in tr.find_all('td')]
+        if len(texts) < len(spec['cells']):
+            continue
 
+        cells = {}
         try:
-            m1 = float(m1_str)
-            m3 = float(m3_str)
-            m6 = float(m6_str)
-            y1 = float(y1_str)
-            y2 = float(y2_str)
-            y3 = float(y3_str)
-            y5 = float(y5_str)
-            y7 = float(y7_str)
-            y10 = float(y10_str)
-            y20 = float(y20_str)
-            y30 = float(y30_str)
+            for name, text in zip(spec['cells'], texts):
+                if name == 'date':
+                    cells[name] = datetime.strptime(text, spec['date_format']).strftime('%Y%m%d')
+                elif name == 'volume':
+                    cells[name] = int(text.replace(',', ''))
+                elif name:
+                    cells[name] = float(text.replace(',', ''))
         except ValueError as e:
-            logging.error('%s: date can\'t convert' % dt_str)
+            logging.error('Can\'t convert row %s' % texts)
             continue
-        # row exist
-        cmd = 'select exists ( select 1 from "%s" where date = \'%s\' and m1 is not null and m3 is not null and m6 is not null and y1 is not null and y2 is not null and y3 is not null and y5 is not null and y7 is not null and y10 is not null and y20 is not null and y30 is not null )' % (tbl_name, dt_str)
-        cursor.execute(cmd)
-        rows = cursor.fetchall()
-        for row in rows:
-            # check row
-            if not row[0]:
-                cmd = 'insert into "%s" values ( \'%s\', %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f )' % ( tbl_name, dt_str, m1, m3, m6, y1, y2, y3, y5, y7, y10, y20, y30 )
-                cursor.execute(cmd)
-                conn.commit()
-            else:
-                cmd = 'update "%s" set ( m1, m3, m6, y1, y2, y3, y5, y7, y10, y20, y30 ) = ( %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f ) where date = \'%s\' ' % ( tbl_name, m1, m3, m6, y1, y2, y3, y5, y7, y10, y20, y30, dt_str )
-                cursor.execute(cmd)
-                conn.commit()
 
-    conn.close()
+        records.append((cells['date'], tuple(cells[c] for c in columns)))
 
-def get_page(url):
-    from selenium import webdriver
-    driver = webdriver.PhantomJS(executable_path='/usr/bin/phantomjs')
+    soup.decompose()
 
-    try:
-        driver.get(url)
-        pageSource = driver.page_source
-    except:
-        logging.error('html retrieve failed')
-        pageSource = None
+    return records
 
-    driver.close()
+def write_table(dbname, tbl_name, columns, records, storage='table'):
+    if not records:
+        logging.error('No rows parsed for %s' % tbl_name)
+        return
 
-    return pageSource
+    with db.connection(dbname) as conn:
+        cursor = conn.cursor()
 
-def update_investing_tbl(dbname, tbl_name, xml_doc):
-    conn = psycopg2.connect(database=dbname, user=getpass.getuser())
-    cursor = conn.cursor()
-    cmd = 'select exists ( select 1 from information_schema.tables where table_name = \'%s\' )' % tbl_name
-    cursor.execute(cmd)
-    rows = cursor.fetchall()
-    for row in rows:
-        if not row[0]:
-            # not exist, create table
-            cmd = 'create table "%s" ( date date, open real, high real, low real, close real )' % tbl_name
-            cursor.execute(cmd)
+        if storage == 'long':
+            # older runs put these in daily_price, where they passed for trading days
+            db.move_macro_price(cursor, [tbl_name])
+            values = dict(zip(columns, zip(*(r[1] for r in records))))
+            volume = values.get('volume', [None] * len(records))
+            rows = zip((r[0] for r in records), volume, values['open'], values['high'], values['low'], values['close'])
+            db.copy_macro_price(cursor, [(tbl_name,) + r for r in rows])
             conn.commit()
+            return
 
-    soup = BeautifulSoup(xml_doc, 'lxml')
-    table = soup.find('table', 'genTbl closedTbl historicalTbl')
-    tbody = table.find('tbody')
-    tr = tbody.find('tr')
-
-    while tr:
-        try:
-            td = tr.find('td')
-            dt = datetime.strptime(td.get_text(strip=True), '%b %d, %Y')
-            dt_str = dt.strftime('%Y%m%d')
-            td = td.next_sibling.next_sibling
-            cl_str = td.get_text(strip=True)
-            ind = cl_str.find(',')
-            if ind:
-                cl = float(cl_str.replace(',', ''))
-            else:
-                cl = float(cl_str)
-            td = td.next_sibling.next_sibling
-            op_str = td.get_text(strip=True)
-            ind = op_str.find(',')
-            if ind:
-                op = float(op_str.replace(',', ''))
-            else:
-                op = float(op_str)
-            td = td.next_sibling.next_sibling
-            hi_str = td.get_text(strip=True)
-            ind = hi_str.find(',')
-            if ind:
-                hi = float(hi_str.replace(',', ''))
-            else:
-                hi = float(hi_str)
-            td = td.next_sibling.next_sibling
-            lo_str = td.get_text(strip=True)
-            ind = lo_str.find(',')
-            if ind:
-                lo = float(lo_str.replace(',', ''))
-            else:
-                lo = float(lo_str)
-        except:
-            logging.error('Can\'t convert %s data' % tbl_name)
-            break
-
-        # row exist
-        cmd = 'select exists ( select 1 from "%s" where date = \'%s\' and open is not null and high is not null and low is not null and close is not null )' % (tbl_name, dt_str)
-        cursor.execute(cmd)
-        rows = cursor.fetchall()
-        for row in rows:
-            # check row
-            if not row[0]:
-                cmd = 'insert into "%s" values ( \'%s\', %f, %f, %f, %f ) ' % (tbl_name, dt_str, op, hi, lo, cl)
-                cursor.execute(cmd)
-                conn.commit()
-            else:
-                cmd = 'update "%s" set (open, high, low, close) = (%f, %f, %f, %f)  where date = \'%s\'' % (tbl_name, op, hi, lo, cl, dt_str)
-                cursor.execute(cmd)
-                conn.commit()
+        types = sql.SQL(', ').join(sql.SQL('{} %s' % ('integer' if c == 'volume' else 'real')).format(db.ident(c)) for c in columns)
+        cursor.execute(sql.SQL('create table if not exists {} ( date date primary key, {} )').format(db.ident(tbl_name), types))
+        db.ensure_date_keys(cursor, [tbl_name])
 
-        tr = tr.next_sibling.next_sibling
+        upsert_rows(cursor, tbl_name, columns, records)
+        conn.commit()
 
-    conn.close()
-    soup.clear()
+def load_table(dbname, tbl_name, spec, html_doc, storage='table'):
+    write_table(dbname, tbl_name, spec_columns(spec), parse_table(spec, html_doc), storage)
 
-def update_DXY_tbl(dbname, tbl_name, xml_doc):
-    conn = psycopg2.connect(database=dbname, user=getpass.getuser())
-    cursor = conn.cursor()
-    cmd = 'select exists ( select 1 from information_schema.tables where table_name = \'%s\' )' % tbl_name
-    cursor.execute(cmd)
-    rows = cursor.fetchall()
-    for row in rows:
-        if not row[0]:
-            # not exist, create table
-            cmd = 'create table "%s" ( date date, open real, high real, low real, close real )' % tbl_name
-            cursor.execute(cmd)
-            conn.commit()
+def update_investing_tbl(dbname, tbl_name, xml_doc, storage='table'):
+    load_table(dbname, tbl_name, TABLE_SPECS['investing'], xml_doc, storage)
 
-    soup = BeautifulSoup(xml_doc, 'lxml')
-    table = soup.find('table', 'instHistoryTbl')
-    tbody = table.find('tbody', 'js-history-data')
-    tr = tbody.find('tr')
+def update_DXY_tbl(dbname, tbl_name, xml_doc, storage='table'):
+    load_table(dbname, tbl_name, TABLE_SPECS['investing-mobile'], xml_doc, storage)
 
-    while tr:
-        try:
-            td = tr.find('td')
-            dt = datetime.strptime(td.get_text(strip=True), '%b %d, %Y')
-            dt_str = dt.strftime('%Y%m%d')
-            td = td.next_sibling.next_sibling
-            cl = float(td.get_text(strip=True))
-            td = td.next_sibling.next_sibling
-            op = float(td.get_text(strip=True))
-            td = td.next_sibling.next_sibling
-            hi = float(td.get_text(strip=True))
-            td = td.next_sibling.next_sibling
-            lo = float(td.get_text(strip=True))
-        except:
-            logging.error('Can\'t convert DXY data')
-            break
-
-        # row exist
-        cmd = 'select exists ( select 1 from "%s" where date = \'%s\' and open is not null and high is not null and low is not null and close is not null )' % (tbl_name, dt_str)
-        cursor.execute(cmd)
-        rows = cursor.fetchall()
-        for row in rows:
-            # check row
-            if not row[0]:
-                cmd = 'insert into "%s" values ( \'%s\', %f, %f, %f, %f ) ' % (tbl_name, dt_str, op, hi, lo, cl)
-                cursor.execute(cmd)
-                conn.commit()
-            else:
-                cmd = 'update "%s" set (open, high, low, close) = (%f, %f, %f, %f) where date = \'%s\'' % (tbl_name, op, hi, lo, cl, dt_str)
-                cursor.execute(cmd)
-                conn.commit()
+def update_yahoo_tbl(dbname, tbl_name, xml_doc, storage='table'):
+    load_table(dbname, tbl_name, TABLE_SPECS['yahoo'], xml_doc, storage)
 
-        tr = tr.next_sibling.next_sibling
+# ( table, url, TABLE_SPECS key ), a new instrument only needs a line here
+SOURCES = [
+    ('DEBY', 'https://www.investing.com/rates-bonds/germany-10-year-bond-yield-historical-data', 'investing'),
+    ('BADI', 'https://www.investing.com/indices/baltic-dry-historical-data', 'investing'),
+    ('DXY', 'https://m.investing.com/indices/usdollar-historical-data', 'investing-mobile'),
+    ('MOO', 'https://finance.yahoo.com/quote/MOO/history?p=MOO', 'yahoo'),
+    ('RSX', 'https://finance.yahoo.com/quote/RSX/history?p=RSX', 'yahoo'),
+]
 
-    conn.close()
-    soup.clear()
+def timed_call(func, *args):
+    # runs in the parse pool, reports its own duration
+    start = time.time()
+    result = func(*args)
 
-def update_yahoo_tbl(dbname, tbl_name, xml_doc):
-    conn = psycopg2.connect(database=dbname, user=getpass.getuser())
-    cursor = conn.cursor()
-    cmd = 'select exists ( select 1 from information_schema.tables where table_name = \'%s\' )' % tbl_name
-    cursor.execute(cmd)
-    rows = cursor.fetchall()
-    for row in rows:
-        if not row[0]:
-            # not exist, create table
-            cmd = 'create table "%s" ( date date, open real, high real, low real, close real, volume integer )' % tbl_name
-            cursor.execute(cmd)
-            conn.commit()
+    return result, time.time() - start
 
-    soup = BeautifulSoup(xml_doc, 'lxml')
-    tr = soup.find('tr', 'BdT')
+def spawn(func, *args):
+    # runs func on a daemon thread of its own, a source that hangs past its
+    # timeout can't hold the process open after refresh() gave up on it
+    future = Future()
 
-    while tr:
-        td = tr.find('td')
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
         try:
-            dt = datetime.strptime(td.next_element.get_text(strip=True), '%b %d, %Y')
-            dt_str = dt.strftime('%Y%m%d')
-            td = td.next_sibling
-            po = float(td.next_element.get_text(strip=True))
-            td = td.next_sibling
-            ph = float(td.next_element.get_text(strip=True))
-            td = td.next_sibling
-            pl = float(td.next_element.get_text(strip=True))
-            td = td.next_sibling
-            pc = float(td.next_element.get_text(strip=True))
-            td = td.next_sibling.next_sibling
-            vol_str = td.next_element.get_text(strip=True)
-            ind = vol_str.find(',')
-            if ind:
-                vol = int(vol_str.replace(',', ''))
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    return future
+
+def refresh(dbname, storage='table', incremental=True, browser=False, timeout=120, parse_workers=None, per_host=2):
+    # fetch every source concurrently, parse in a process pool and write
+    # from this thread only as each page becomes ready
+    jobs = [('USTY', USTY_URL, None)] + SOURCES
+    latest = get_USTY_latest(dbname, 'USTY') if incremental else None
+    stats = dict((name, {'fetch': 0.0, 'parse': 0.0, 'write': 0.0, 'rows': 0, 'status': 'timeout'}) for name, url, spec in jobs)
+    fetcher = get_fetcher()
+
+    def fetch_job(name, url, spec):
+        start = time.time()
+        page = fetcher.get(rebase(url), browser and spec is not None, spec is None)
+        stats[name]['fetch'] = time.time() - start
+        metrics.observe('fetch', stats[name]['fetch'], source=name)
+        return page
+
+    procs = ProcessPoolExecutor(max_workers=parse_workers)
+    # future -> [ stage, job, started ], each stage of a source gets timeout
+    # seconds from when it stops queueing, for a fetch behind the per-host
+    # limit and for a parse behind the busy workers, whatever the others do
+    pending = {}
+    # sources wait here for a free slot on their host; one that timed out
+    # gives its slot up at once even if its request is still hanging
+    queued = list(jobs)
+    running = {}
+
+    def host(job):
+        return urlsplit(rebase(job[1])).netloc
+
+    def launch():
+        for job in list(queued):
+            if running.get(host(job), 0) < per_host:
+                running[host(job)] = running.get(host(job), 0) + 1
+                queued.remove(job)
+                pending[spawn(fetch_job, *job)] = ['fetch', job, time.time()]
+
+    launch()
+    while pending:
+        now = time.time()
+        for future, entry in pending.items():
+            if entry[2] is None and (future.running() or future.done()):
+                entry[2] = now
+        started = [entry[2] for entry in pending.values() if entry[2] is not None]
+        left = min(started) + timeout - now if started else timeout
+        if len(started) < len(pending):
+            # look again soon for the ones still queued
+            left = min(left, 0.1)
+        done, not_done = wait(pending, timeout=max(left, 0), return_when=FIRST_COMPLETED)
+
+        now = time.time()
+        for future in not_done:
+            stage, job, began = pending[future]
+            if began is not None and began + timeout <= now:
+                logging.error('%s: gave up after %ds in %s' % (job[0], timeout, stage))
+                future.cancel()
+                del pending[future]
+                if stage == 'fetch':
+                    running[host(job)] -= 1
+
+        for future in done:
+            if pending[future][0] == 'fetch':
+                running[host(pending[future][1])] -= 1
+        launch()
+
+        for future in done:
+            stage, (name, url, spec), began = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error('%s: %s failed: %s' % (name, stage, e))
+                stats[name]['status'] = '%s failed' % stage
+                continue
+
+            if stage == 'fetch':
+                if not result:
+                    logging.error('No %s data' % name)
+                    stats[name]['status'] = 'no data'
+                    continue
+                if spec is None:
+                    parse = procs.submit(timed_call, parse_USTY, result, latest)
+                else:
+                    parse = procs.submit(timed_call, parse_table, TABLE_SPECS[spec], result)
+                pending[parse] = ['parse', (name, url, spec), None]
+                continue
+
+            records, stats[name]['parse'] = result
+            metrics.observe('parse', stats[name]['parse'], source=name)
+            start = time.time()
+            if spec is None:
+                write_USTY(dbname, name, records)
             else:
-                vol = int(vol_str)
-        except:
-            print('Can\'t convert data!')
-            break
+                write_table(dbname, name, spec_columns(TABLE_SPECS[spec]), records, storage)
+            stats[name]['write'] = time.time() - start
+            stats[name]['rows'] = len(records)
+            stats[name]['status'] = 'ok'
+            metrics.observe('write', stats[name]['write'], source=name)
+            metrics.inc('rows', len(records), source=name, action='written')
 
-        # row exist
-        cmd = 'select exists ( select 1 from "%s" where date = \'%s\' and open is not null and high is not null and low is not null and close is not null and volume is not null )' % (tbl_name, dt_str)
-        cursor.execute(cmd)
-        rows = cursor.fetchall()
-        for row in rows:
-            # check row
-            if not row[0]:
-                cmd = 'insert into "%s" values ( \'%s\', %f, %f, %f, %f, %d ) ' % (tbl_name, dt_str, po, ph, pl, pc, vol)
-                cursor.execute(cmd)
-                conn.commit()
-            else:
-                cmd = 'update "%s" set ( open, high, low, close, volume ) = ( %f, %f, %f, %f, %d ) where date = \'%s\'' % (tbl_name, po, ph, pl, pc, vol, dt_str)
-                cursor.execute(cmd)
-                conn.commit()
+    for name, st in stats.items():
+        metrics.inc('sources', source=name, status=st['status'])
+
+    # don't wait on anything that timed out
+    procs.shutdown(wait=False, cancel_futures=True)
 
-        # to next row
-        tr = tr.next_sibling
+    return stats
 
-    conn.close()
-    soup.clear()
+def print_summary(stats):
+    print('%-6s %8s %8s %8s %7s  %s' % ('source', 'fetch', 'parse', 'write', 'rows', 'status'))
+    for name, st in stats.items():
+        print('%-6s %7.2fs %7.2fs %7.2fs %7d  %s' % (name, st['fetch'], st['parse'], st['write'], st['rows'], st['status']))
 
 def main(argv):
     args = parser().parse_args(argv[1:])
@@ -310,58 +391,21 @@ def main(argv):
                         format='%(asctime)s\t%(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
 
-    xml_doc = get_USTY()
-
-    if xml_doc:
-        update_USTY_tbl(args.dbname, 'USTY', xml_doc)
-    else:
-        logging.error('No USTY data')
-
-    # Get DEBY page
-    url = 'https://www.investing.com/rates-bonds/germany-10-year-bond-yield-historical-data'
-    html_doc = get_page(url)
-
-    if html_doc:
-        update_investing_tbl(args.dbname, 'DEBY', html_doc)
-    else:
-        logging.error('No DEBY data')
-
-    # Get BADI page
-    url = 'https://www.investing.com/indices/baltic-dry-historical-data'
-    html_doc = get_page(url)
-
-    if html_doc:
-        update_investing_tbl(args.dbname, 'BADI', html_doc)
-    else:
-        logging.error('No BADI data')
-
-    # Get DXY page
-    url = 'https://m.investing.com/indices/usdollar-historical-data'
-    html_doc = get_page(url)
-
-    if html_doc:
-        update_DXY_tbl(args.dbname, 'DXY', html_doc)
-    else:
-        logging.error('No DXY data')
-
-    # Get MOO page
-    url = 'https://finance.yahoo.com/quote/MOO/history?p=MOO'
-    html_doc = get_page(url)
-
-    if html_doc:
-        update_yahoo_tbl(args.dbname, 'MOO', html_doc)
-    else:
-        logging.error('No MOO data')
+    global base_url
+    base_url = args.base_url
 
-    # Get RSX page
-    url = 'https://finance.yahoo.com/quote/RSX/history?p=RSX'
-    html_doc = get_page(url)
+    global fetcher
+    # refresh() keeps to --per-host itself, a request it gave up on must
+    # not hold a slot in the fetcher
+    fetcher = fetch.PageFetcher(per_host=len(SOURCES) + 1, retries=args.retries)
 
-    if html_doc:
-        update_yahoo_tbl(args.dbname, 'RSX', html_doc)
-    else:
-        logging.error('No RSX data')
+    stats = refresh(args.dbname, args.storage, not args.full, args.browser,
+                    args.timeout, args.parse_workers, args.per_host)
+    print_summary(stats)
+    metrics.emit(args.metrics, args.prometheus, 'stock_updatetbl')
 
+    fetcher.close()
+    db.close_all()
 
 if __name__ == '__main__':
     try: